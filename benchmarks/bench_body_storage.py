@@ -0,0 +1,118 @@
+"""
+Measures the size of the database and the scan speed of the post metadata and bodies, with the bodies stored in
+the posts table (the layout of the unversioned databases) and after the migration moving them to the post_bodies
+table, uncompressed and compressed with zlib and zstd (when the zstandard package is installed).
+
+Usage:
+    python benchmarks/bench_body_storage.py [--posts 20000] [--words 800]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from driver.utils import dbops
+
+METADATA_SCAN = 'SELECT COUNT(DISTINCT domain), MAX(date), SUM(like_count), MAX(LENGTH(title)) FROM posts'
+DOMAIN_COUNTS = 'SELECT domain, COUNT(*), MAX(date) FROM posts GROUP BY domain'
+
+
+def synthetic_posts(count, words):
+    # Words drawn from a Zipf distribution, compresses about like English prose
+    generator = random.Random(0)
+    vocabulary = [''.join(generator.choices('etaoinshrdlucmfwypvbgkqjxz', k=generator.randint(2, 9)))
+                  for _ in range(5000)]
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    return [{
+        'domain': f'domain{i % 50}',
+        'url': f'https://domain{i % 50}.substack.com/p/post-{i}',
+        'title': f'Post {i}',
+        'date': f'2024-{1 + i % 12:02d}-{1 + i % 28:02d}',
+        'like_count': i,
+        'md': '\n\n'.join(' '.join(generator.choices(vocabulary, weights, k=length // 8)) for _ in range(8)),
+    } for i, length in enumerate(generator.randint(words // 4, words * 7 // 4) for _ in range(count))]
+
+
+def create_legacy_db(path, posts):
+    connection = sqlite3.connect(path)
+    for statement in dbops.SCHEMA:
+        connection.execute(statement)
+    with connection:
+        connection.executemany('INSERT INTO posts (domain, url, title, date, like_count, md) VALUES (?, ?, ?, ?, ?, ?)',
+                               ((post['domain'], post['url'], post['title'], post['date'], post['like_count'],
+                                 post['md']) for post in posts))
+    connection.execute('VACUUM')
+    connection.close()
+
+
+def timed(connection, query, runs=3):
+    start = time.perf_counter()
+    for _ in range(runs):
+        connection.execute(query).fetchall()
+    return (time.perf_counter() - start) / runs
+
+
+def measure(label, path, read_bodies):
+    # A new connection with a small page cache, the scans read the pages from the file (through the OS cache)
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA cache_size = -2000')
+    metadata = timed(connection, METADATA_SCAN)
+    counts = timed(connection, DOMAIN_COUNTS)
+    connection.close()
+    start = time.perf_counter()
+    read_bodies()
+    bodies = time.perf_counter() - start
+    size = os.path.getsize(path) / 2 ** 20
+    print(f'{label:>22}: {size:8.1f} MiB  metadata scan {metadata * 1000:7.1f} ms  '
+          f'group by domain {counts * 1000:7.1f} ms  all bodies {bodies * 1000:7.1f} ms')
+    return size, metadata
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the storage of the post bodies.')
+    parser.add_argument('--posts', type=int, default=20000, help='Number of synthetic posts')
+    parser.add_argument('--words', type=int, default=800, help='Average number of words per post body')
+    args = parser.parse_args()
+    posts = synthetic_posts(args.posts, args.words)
+
+    with tempfile.TemporaryDirectory() as folder:
+        legacy = os.path.join(folder, 'legacy.db')
+        create_legacy_db(legacy, posts)
+
+        def legacy_bodies():
+            connection = sqlite3.connect(legacy)
+            connection.row_factory = sqlite3.Row
+            [dict(row) for row in connection.execute('SELECT * FROM posts WHERE processed = FALSE')]
+            connection.close()
+
+        before_size, before_scan = measure('md in posts', legacy, legacy_bodies)
+
+        for compression in (None, 'zlib', 'zstd'):
+            if compression == 'zstd' and dbops.zstandard is None:
+                print('zstd skipped, the zstandard package is not installed')
+                continue
+            path = os.path.join(folder, f'{compression}.db')
+            shutil.copy(legacy, path)
+            start = time.perf_counter()
+            dbops.initialize_db(path, compression=compression)
+            migration = time.perf_counter() - start
+            dbops.close_db()
+
+            def current_bodies():
+                dbops.initialize_db(path, compression=compression)
+                dbops.get_unprocessed_posts()
+                dbops.close_db()
+
+            size, scan = measure(f'post_bodies, {compression or "text"}', path, current_bodies)
+            print(f'{"":>22}  migration {migration:.2f}s, {before_size / size:.1f}x smaller, '
+                  f'metadata scan {before_scan / scan:.1f}x faster')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Measures the write throughput of the storage layer against the previous write path
+(rollback journal, one INSERT OR REPLACE with a correlated sub-select per post,
+CREATE TABLE and COMMIT for every summary).
+
+Usage:
+    python benchmarks/bench_db_writes.py [--posts 5000] [--summaries 2000] [--batch 10]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from driver.utils import dbops
+
+LEGACY_POSTS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, domain TEXT, blog_title TEXT, url TEXT UNIQUE, title TEXT,
+        subtitle TEXT, like_count INTEGER, date TEXT, md TEXT, source TEXT, created_at TEXT, updated_at TEXT,
+        processed BOOLEAN DEFAULT FALSE
+    )
+'''
+LEGACY_SUMMARIES_TABLE = '''
+    CREATE TABLE IF NOT EXISTS summaries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT UNIQUE, title TEXT, subtitle TEXT, domain TEXT, date TEXT,
+        summary TEXT, category TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+
+def synthetic_posts(count):
+    return [{
+        'domain': f'domain{i % 13}',
+        'blog_title': 'Blog',
+        'url': f'https://domain{i % 13}.substack.com/p/post-{i}',
+        'title': f'Post {i}',
+        'subtitle': 'Subtitle',
+        'like_count': i,
+        'date': datetime(2024, 1, 1 + i % 28).isoformat(),
+        'md': 'Lorem ipsum dolor sit amet. ' * 200,
+    } for i in range(count)]
+
+
+def synthetic_summaries(posts):
+    return [{
+        'url': post['url'],
+        'title': post['title'],
+        'subtitle': post['subtitle'],
+        'domain': post['domain'],
+        'date': post['date'],
+        'summary': 'A short summary of the post. ' * 4,
+        'category': 'technical',
+    } for post in posts]
+
+
+def legacy_save_posts(connection, posts_data):
+    cursor = connection.cursor()
+    cursor.execute(LEGACY_POSTS_TABLE)
+    query = '''
+        INSERT OR REPLACE INTO posts
+        (domain, blog_title, url, title, subtitle, like_count, date, md, source, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE((SELECT created_at FROM posts WHERE url = ?), ?), ?)
+    '''
+    current_time = datetime.now().isoformat()
+    for post in posts_data:
+        cursor.execute(query, (post['domain'], post['blog_title'], post['url'], post['title'], post['subtitle'],
+                               post['like_count'], post['date'], post['md'], 'Substack', post['url'],
+                               current_time, current_time))
+    connection.commit()
+
+
+def legacy_save_summary(connection, summary):
+    cursor = connection.cursor()
+    cursor.execute(LEGACY_SUMMARIES_TABLE)
+    cursor.execute('''
+        INSERT OR REPLACE INTO summaries (url, title, subtitle, domain, date, summary, category)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (summary['url'], summary['title'], summary['subtitle'], summary['domain'], summary['date'],
+          summary['summary'], summary['category']))
+    connection.commit()
+
+
+def timed(label, count, action):
+    start = time.perf_counter()
+    action()
+    elapsed = time.perf_counter() - start
+    print(f'{label:>32}: {elapsed:7.3f}s  {count / elapsed:10.0f} rows/s')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the database write path.')
+    parser.add_argument('--posts', type=int, default=5000, help='Number of synthetic posts')
+    parser.add_argument('--summaries', type=int, default=2000, help='Number of synthetic summaries')
+    parser.add_argument('--batch', type=int, default=10, help='Posts per call in the incremental scenario')
+    args = parser.parse_args()
+    posts = synthetic_posts(args.posts)
+    summaries = synthetic_summaries(posts[:args.summaries])
+    batches = [posts[i:i + args.batch] for i in range(0, len(posts), args.batch)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        legacy = sqlite3.connect(os.path.join(folder, 'legacy.db'))
+        before = timed('legacy posts', len(posts), lambda: legacy_save_posts(legacy, posts))
+        legacy.execute('DELETE FROM posts')
+        legacy.commit()
+        before_batches = timed(f'legacy posts by {args.batch}', len(posts),
+                               lambda: [legacy_save_posts(legacy, batch) for batch in batches])
+        before_summaries = timed('legacy summaries', len(summaries),
+                                 lambda: [legacy_save_summary(legacy, summary) for summary in summaries])
+        legacy.close()
+
+        dbops.initialize_db(os.path.join(folder, 'current.db'))
+        after = timed('save_posts_to_db', len(posts), lambda: dbops.save_posts_to_db(posts))
+        dbops.conn.execute('DELETE FROM posts')
+        dbops.conn.commit()
+        after_batches = timed(f'save_posts_to_db by {args.batch}', len(posts),
+                              lambda: [dbops.save_posts_to_db(batch) for batch in batches])
+        after_single = timed('save_summary_to_db (one by one)', len(summaries),
+                             lambda: [dbops.save_summary_to_db(summary) for summary in summaries])
+        after_summaries = timed('save_summaries_to_db', len(summaries), lambda: dbops.save_summaries_to_db(summaries))
+        dbops.close_db()
+
+    print(f'posts: {before / after:.1f}x at once, {before_batches / after_batches:.1f}x by {args.batch}, '
+          f'summaries: {before_summaries / after_single:.1f}x one by one, {before_summaries / after_summaries:.1f}x batched')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Measures the generation of the HTML digest against the previous approach (summaries.json loaded in memory,
+a new Environment per run and the page rendered as one string), in time and in peak Python memory,
+and the time of an incremental digest once the archive was published.
+
+Usage:
+    python benchmarks/bench_digest.py [--summaries 50000] [--new 100]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from jinja2 import Environment, FileSystemLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from driver.utils import dbops
+from driver.utils.utils import TEMPLATES_FOLDER, generate_html_summary
+
+
+def synthetic_summaries(count, categories, offset=0):
+    return [{
+        'url': f'https://domain{i % 13}.substack.com/p/post-{i}',
+        'title': f'Post {i} about something',
+        'subtitle': '',
+        'domain': f'domain{i % 13}',
+        'date': 'Jan 1, 2024',
+        'summary': 'A short summary of the post, highlighting one or two intriguing insights. ' * 3,
+        'category': categories[i % len(categories)],
+    } for i in range(offset, offset + count)]
+
+
+def legacy_generate(summaries_file, data_folder):
+    with open(summaries_file) as f:
+        summary_data = json.load(f)
+    env = Environment(loader=FileSystemLoader(TEMPLATES_FOLDER))
+    template = env.get_template('summary_template.html')
+    categories = {}
+    for category, items in summary_data.items():
+        categories[category.title()] = [{'domain': item['domain'].upper(), 'summary': item['summary'],
+                                         'title': item['title'].capitalize(), 'url': item['url']} for item in items]
+    # The template iterates over (category, items) pairs
+    html_content = template.render(categories=categories.items())
+    path = os.path.join(data_folder, f"{datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}_legacy.html")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html_content)
+    return path
+
+
+def measured(label, action, memory=True):
+    # Timed and traced in separate runs, tracemalloc slows down the allocations
+    start = time.perf_counter()
+    result = action()
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if memory:
+        tracemalloc.start()
+        action()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    print(f'{label:>34}: {elapsed * 1000:8.1f} ms  peak {peak / 2 ** 20:7.1f} MiB')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the generation of the HTML digest.')
+    parser.add_argument('--summaries', type=int, default=50000, help='Number of summaries in the archive')
+    parser.add_argument('--new', type=int, default=100, help='Number of summaries of the incremental digest')
+    parser.add_argument('--config', type=str, default='etc/config.json', help='Configuration holding the categories')
+    args = parser.parse_args()
+    with open(args.config) as f:
+        configuration = json.load(f)
+    categories = configuration['categories']
+    summaries = synthetic_summaries(args.summaries, categories)
+
+    with tempfile.TemporaryDirectory() as folder:
+        summaries_file = os.path.join(folder, 'summaries.json')
+        bag = {}
+        for summary in summaries:
+            bag.setdefault(summary['category'], []).append(summary)
+        with open(summaries_file, 'w') as f:
+            json.dump(bag, f)
+        del bag
+        legacy = measured('summaries.json, render to a string', lambda: legacy_generate(summaries_file, folder))
+
+        dbops.initialize_db(os.path.join(folder, 'posts.db'))
+        dbops.save_summaries_to_db(summaries)
+        del summaries
+        full = dict(configuration, digest={'window_days': 0, 'incremental': False})
+        current = measured('database, streamed (whole archive)', lambda: generate_html_summary(folder, full))
+        assert os.path.getsize(current) == os.path.getsize(legacy)
+
+        published = dict(configuration, digest={'window_days': 7, 'incremental': True})
+        generate_html_summary(folder, published)
+        dbops.save_summaries_to_db(synthetic_summaries(args.new, categories, offset=args.summaries))
+        incremental = measured(f'incremental, {args.new} new summaries',
+                               lambda: generate_html_summary(folder, published), memory=False)
+        print(f'incremental digest of {os.path.getsize(incremental) / 1024:.0f} KiB '
+              f'instead of {os.path.getsize(legacy) / 2 ** 20:.1f} MiB for the whole archive')
+        dbops.close_db()
+
+
+if __name__ == '__main__':
+    main()
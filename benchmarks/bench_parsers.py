@@ -0,0 +1,53 @@
+"""
+Compares the HTML parser backends on saved Substack post pages.
+
+Usage:
+    python benchmarks/bench_parsers.py <folder with saved *.html pages> [--repeat 20]
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from driver.scrapers.parsers import available_parsers, get_parser, PAYWALL_SELECTOR, CONTENT_SELECTOR, SELECTORS
+
+
+def extract(parser, html: bytes):
+    document = parser.parse(html)
+    if parser.exists(document, PAYWALL_SELECTOR):
+        return None
+    fields = [parser.text(document, selector) for selector in SELECTORS if selector not in (PAYWALL_SELECTOR, CONTENT_SELECTOR)]
+    return fields, parser.html(document, CONTENT_SELECTOR)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark the HTML parser backends on saved pages.')
+    arg_parser.add_argument('pages', type=str, help='Folder containing saved *.html post pages')
+    arg_parser.add_argument('--repeat', type=int, default=20, help='Number of passes over the pages')
+    args = arg_parser.parse_args()
+
+    pages = []
+    for path in sorted(glob.glob(os.path.join(args.pages, '*.html'))):
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+    if not pages:
+        raise SystemExit(f'No *.html pages found in {args.pages}')
+    print(f'{len(pages)} pages, {sum(len(p) for p in pages) / 1024:.0f} KiB, {args.repeat} passes')
+
+    baseline = None
+    for name in reversed(available_parsers()):
+        parser = get_parser(name)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for html in pages:
+                extract(parser, html)
+        per_page = (time.perf_counter() - start) / (args.repeat * len(pages)) * 1000
+        baseline = baseline or per_page
+        print(f'{name:>12}: {per_page:8.2f} ms/page  {baseline / per_page:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Measures the per-post prompt rendering overhead of the summarize step against the previous approach
+(a Template compiled from the configuration for the user and system prompts of every post).
+
+Usage:
+    python benchmarks/bench_prompts.py [--posts 500] [--config etc/config.json]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from jinja2 import Template
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from driver.prompts import FALLBACK_CATEGORY, PromptRenderer
+
+
+def synthetic_posts(count):
+    return [{
+        'url': f'https://domain{i % 13}.substack.com/p/post-{i}',
+        'title': f'Post {i}',
+        'domain': f'domain{i % 13}',
+        'md': f'# Post {i}\n\n' + 'Lorem ipsum dolor sit amet. ' * 400,
+    } for i in range(count)]
+
+
+def legacy_render(configuration, post, categories):
+    user_prompt = Template(configuration.get('user_prompt', '')).render(categories=categories, post=post,
+                                                                        fallback_category=FALLBACK_CATEGORY)
+    system_prompt = Template(configuration.get('system_prompt', '')).render()
+    return user_prompt, system_prompt
+
+
+def timed(label, count, action):
+    start = time.perf_counter()
+    action()
+    elapsed = time.perf_counter() - start
+    print(f'{label:>31}: {elapsed:7.3f}s  {elapsed / count * 1e6:8.1f} us/post')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the rendering of the summarization prompts.')
+    parser.add_argument('--posts', type=int, default=500, help='Number of synthetic posts')
+    parser.add_argument('--config', type=str, default='etc/config.json', help='Configuration holding the prompts')
+    args = parser.parse_args()
+    with open(args.config) as f:
+        configuration = json.load(f)
+    posts = synthetic_posts(args.posts)
+    # The same variables as the PromptRenderer, which adds the fallback category when it is not configured
+    categories = list(configuration.get('categories', []))
+    if categories and FALLBACK_CATEGORY not in {category.lower() for category in categories}:
+        categories.append(FALLBACK_CATEGORY)
+
+    before = timed('Template per post', len(posts),
+                   lambda: [legacy_render(configuration, post, categories) for post in posts])
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cold = timed('PromptRenderer (compiling)', 1, lambda: PromptRenderer(configuration, cache_dir))
+        warm = timed('PromptRenderer (bytecode cache)', 1, lambda: PromptRenderer(configuration, cache_dir))
+        prompts = PromptRenderer(configuration, cache_dir)
+        after = timed('PromptRenderer.render', len(posts), lambda: [prompts.render(post) for post in posts])
+
+    assert legacy_render(configuration, posts[0], categories) == prompts.render(posts[0])
+    print(f'{before / after:.1f}x faster per post, setup: {cold * 1000:.1f} ms cold, {warm * 1000:.1f} ms from the bytecode cache')
+
+
+if __name__ == '__main__':
+    main()
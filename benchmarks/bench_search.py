@@ -0,0 +1,114 @@
+"""
+Measures the latency of search_posts on a synthetic archive against the previous way to find posts
+(a LIKE scan of the Markdown bodies stored in the posts table).
+
+Usage:
+    python benchmarks/bench_search.py [--posts 5000] [--words 800] [--compression zlib]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from driver.utils import dbops
+
+LEGACY_POSTS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, domain TEXT, blog_title TEXT, url TEXT UNIQUE, title TEXT,
+        subtitle TEXT, like_count INTEGER, date TEXT, md TEXT, source TEXT, created_at TEXT, updated_at TEXT,
+        processed BOOLEAN DEFAULT FALSE
+    )
+'''
+
+
+def synthetic_posts(count, words):
+    # Words drawn from a Zipf distribution, the first ones of the vocabulary are frequent, the last ones rare
+    generator = random.Random(0)
+    vocabulary = [''.join(generator.choices('etaoinshrdlucmfwypvbgkqjxz', k=generator.randint(3, 9)))
+                  for _ in range(20000)]
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+
+    def text(length):
+        return ' '.join(generator.choices(vocabulary, weights, k=length))
+
+    posts = [{
+        'domain': f'domain{i % 50}',
+        'url': f'https://domain{i % 50}.substack.com/p/post-{i}',
+        'title': text(6),
+        'subtitle': text(12),
+        'date': f'2024-{1 + i % 12:02d}-{1 + i % 28:02d}',
+        'md': '\n\n'.join(text(words // 8) for _ in range(8)),
+        'summary': text(40),
+    } for i in range(count)]
+    return posts, vocabulary
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the full-text search of the posts.')
+    parser.add_argument('--posts', type=int, default=5000, help='Number of synthetic posts')
+    parser.add_argument('--words', type=int, default=800, help='Words per post body')
+    parser.add_argument('--compression', type=str, default='zlib', help='Compression of the post bodies')
+    parser.add_argument('--runs', type=int, default=20, help='Runs per query')
+    args = parser.parse_args()
+    posts, vocabulary = synthetic_posts(args.posts, args.words)
+    queries = {
+        'frequent word': vocabulary[3],
+        'common word': vocabulary[200],
+        'rare word': vocabulary[15000],
+        'two words': f'{vocabulary[50]} {vocabulary[400]}',
+        'phrase': f'"{vocabulary[20]} {vocabulary[21]}"',
+        'prefix': vocabulary[120][:3] + '*',
+        'or': f'{vocabulary[900]} OR {vocabulary[1500]}',
+    }
+
+    with tempfile.TemporaryDirectory() as folder:
+        legacy = sqlite3.connect(os.path.join(folder, 'legacy.db'))
+        legacy.execute(LEGACY_POSTS_TABLE)
+        with legacy:
+            legacy.executemany('INSERT INTO posts (domain, url, title, subtitle, date, md) VALUES (?, ?, ?, ?, ?, ?)',
+                               ((post['domain'], post['url'], post['title'], post['subtitle'], post['date'],
+                                 post['md']) for post in posts))
+
+        dbops.initialize_db(os.path.join(folder, 'posts.db'), compression=args.compression)
+        start = time.perf_counter()
+        dbops.save_posts_to_db(posts)
+        dbops.save_summaries_to_db(posts)
+        indexing = time.perf_counter() - start
+        size = os.path.getsize(os.path.join(folder, 'posts.db')) / 2 ** 20
+        print(f'{args.posts} posts saved and indexed in {indexing:.1f}s, database of {size:.1f} MiB')
+
+        print(f'{"":>14}  {"matches":>8}  {"p50":>8}  {"p95":>8}  {"max":>8}')
+        worst = 0
+        for label, query in queries.items():
+            timings = []
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                results = dbops.search_posts(query, limit=10)
+                timings.append((time.perf_counter() - start) * 1000)
+            matches = dbops.conn.execute('SELECT COUNT(*) FROM (SELECT rowid FROM posts_fts WHERE posts_fts MATCH ? UNION '
+                                         'SELECT posts.id FROM summaries_fts JOIN summaries ON summaries.id = summaries_fts.rowid '
+                                         'JOIN posts ON posts.url = summaries.url WHERE summaries_fts MATCH ?)',
+                                         (query, query)).fetchone()[0]
+            timings.sort()
+            worst = max(worst, timings[-1])
+            print(f'{label:>14}  {matches:8d}  {statistics.median(timings):6.2f}ms  '
+                  f'{timings[int(len(timings) * 0.95) - 1]:6.2f}ms  {timings[-1]:6.2f}ms')
+            assert results or not matches
+        dbops.close_db()
+
+        start = time.perf_counter()
+        legacy.execute('SELECT url FROM posts WHERE md LIKE ? ORDER BY date DESC LIMIT 10',
+                       (f'%{vocabulary[15000]}%',)).fetchall()
+        like = (time.perf_counter() - start) * 1000
+        legacy.close()
+    print(f'LIKE scan of the bodies (rare word, unranked): {like:.1f}ms, slowest search: {worst:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
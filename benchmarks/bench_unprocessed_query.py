@@ -0,0 +1,103 @@
+"""
+Measures the latency of get_recent_unprocessed_posts_by_domain on a synthetic database against the previous query
+(ROW_NUMBER window over SELECT * of every unprocessed post, without an index on processed, domain or date).
+
+Usage:
+    python benchmarks/bench_unprocessed_query.py [--posts 100000] [--domains 200] [--processed 0.7] [--limit 3]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from driver.utils import dbops
+
+LEGACY_POSTS_TABLE = '''
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, domain TEXT, blog_title TEXT, url TEXT UNIQUE, title TEXT,
+        subtitle TEXT, like_count INTEGER, date TEXT, md TEXT, source TEXT, created_at TEXT, updated_at TEXT,
+        processed BOOLEAN DEFAULT FALSE
+    )
+'''
+LEGACY_QUERY = '''
+    WITH ranked_posts AS (
+        SELECT *,
+               ROW_NUMBER() OVER (PARTITION BY domain ORDER BY date DESC) as rank
+        FROM posts
+        WHERE processed = FALSE
+    )
+    SELECT * FROM ranked_posts
+    WHERE rank <= ?
+    ORDER BY domain, date DESC
+'''
+
+
+def synthetic_posts(count, domains):
+    start = datetime(2020, 1, 1)
+    return [{
+        'domain': f'domain{i % domains}',
+        'blog_title': 'Blog',
+        'url': f'https://domain{i % domains}.substack.com/p/post-{i}',
+        'title': f'Post {i}',
+        'subtitle': 'Subtitle',
+        'like_count': i,
+        'date': (start + timedelta(hours=i)).isoformat(),
+        'md': f'# Post {i}\n\n' + 'Lorem ipsum dolor sit amet. ' * 150,
+    } for i in range(count)]
+
+
+def timed(label, runs, action):
+    action()  # warms the page cache
+    start = time.perf_counter()
+    for _ in range(runs):
+        result = action()
+    elapsed = (time.perf_counter() - start) / runs
+    print(f'{label:>38}: {elapsed * 1000:8.2f} ms  ({len(result)} posts)')
+    return elapsed, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the selection of the posts to summarize.')
+    parser.add_argument('--posts', type=int, default=100000, help='Number of synthetic posts')
+    parser.add_argument('--domains', type=int, default=200, help='Number of publications')
+    parser.add_argument('--processed', type=float, default=0.7, help='Share of the posts already processed')
+    parser.add_argument('--limit', type=int, default=3, help='Posts selected per domain')
+    parser.add_argument('--runs', type=int, default=5, help='Timed runs per query')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        posts = synthetic_posts(args.posts, args.domains)
+        processed = {post['url'] for i, post in enumerate(posts) if i % 100 < args.processed * 100}
+        print(f'{args.posts} posts, {args.posts - len(processed)} unprocessed in {args.domains} domains')
+
+        legacy = sqlite3.connect(os.path.join(folder, 'legacy.db'))
+        legacy.row_factory = sqlite3.Row
+        legacy.execute(LEGACY_POSTS_TABLE)
+        with legacy:
+            legacy.executemany('INSERT INTO posts (domain, url, title, date, md, processed) VALUES (?, ?, ?, ?, ?, ?)',
+                               ((post['domain'], post['url'], post['title'], post['date'], post['md'],
+                                 post['url'] in processed) for post in posts))
+        before, expected = timed('window over SELECT *, no index', args.runs,
+                                 lambda: [dict(row) for row in legacy.execute(LEGACY_QUERY, (args.limit,)).fetchall()])
+        legacy.close()
+
+        dbops.initialize_db(os.path.join(folder, 'posts.db'))
+        dbops.save_posts_to_db(posts)
+        with dbops.conn:
+            dbops.conn.executemany('UPDATE posts SET processed = 1 WHERE url = ?', ((url,) for url in processed))
+        dbops.conn.execute('ANALYZE')
+        after, result = timed('ids ranked on the partial index', args.runs,
+                              lambda: dbops.get_recent_unprocessed_posts_by_domain(args.limit))
+        dbops.close_db()
+
+    assert [(post['url'], post['md']) for post in expected] == [(post['url'], post['md']) for post in result]
+    print(f'{before / after:.1f}x faster')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,3 @@
 from .utils.utils import generate_html_summary
-from .utils.dbops import save_posts_to_db, get_existing_urls_for_domain, get_recent_unprocessed_posts_by_domain, mark_posts_as_processed
+from .utils.dbops import save_posts_to_db, get_existing_urls_for_domain, filter_new_urls, get_recent_unprocessed_posts_by_domain, mark_posts_as_processed, claim_recent_posts, mark_posts_as_failed
 from .agents import process_posts
@@ -1,14 +1,30 @@
 import time
 import json
+import asyncio
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
 import os
 import logging
-from driver.utils.dbops import get_recent_unprocessed_posts_by_domain, mark_posts_as_processed, save_summary_to_db
-from jinja2 import Template
+import queue
+import socket
+import uuid
+from driver.batch import BatchRunner, FakeBatchAPI
+from driver.utils.dbops import (claim_posts_by_url, claim_recent_posts, mark_posts_as_failed, mark_posts_as_processed,
+                                save_summary_to_db)
+from driver.utils.tokens import count_tokens, split_into_chunks, strip_boilerplate
+from driver.prompts import PromptRenderer
 
 logger = logging.getLogger(__name__)
 
 
-def process_posts(limit=None, summaries_file=None, client=None, configuration=None):
+def process_posts(limit=None, summaries_file=None, client=None, configuration=None, post_queue: queue.Queue = None):
+    """
+    Summarizes the most recent unprocessed posts of every publication and writes them to summaries_file.
+    When post_queue is given, the posts are taken from it instead, as they are scraped, until None is put in the queue.
+    The posts are claimed in the database before they are summarized, so several summarizers can share it,
+    the summarized posts are marked as processed and the others as failed (they are tried again by the next runs).
+    """
     def restructure_summaries(summaries):
         category_bag = {}
         for summary in summaries:
@@ -30,7 +46,7 @@ def process_posts(limit=None, summaries_file=None, client=None, configuration=No
     def filter_invalid_summaries(summaries_bag):
         filtered_bag = {}
         for category, summaries in summaries_bag.items():
-            if category.lower() not in [c.lower() for c in configuration.get('categories', [])]:
+            if category.lower() not in prompts.category_names:
                 logger.warning(f"Filtered out invalid category: {category}")
                 continue
             
@@ -45,66 +61,478 @@ def process_posts(limit=None, summaries_file=None, client=None, configuration=No
                 filtered_bag[category] = valid_summaries
         
         return filtered_bag
-    def process_single_post(post):
-        def create_result(summary, category):
-            return {
-                "url": post.get('url'),
-                "title": post.get('title'),
-                "subtitle": post.get('subtitle'),
-                "domain": post.get('domain'),
-                "date": post.get('date'),
-                "summary": summary,
-                "category": category
-            }
-        
+    def prepare_post(post):
+        """
+        Trims the boilerplate of a post. When it is still over the input budget, its body is split into chunks
+        which are summarized separately before the final summary (map-reduce).
+        Returns the post to summarize and its chunks, None when the post fits in a single prompt.
+        """
+        original = post.get('md') or ''
+        md = strip_boilerplate(original)
+        original_tokens = count_tokens(original, client.model)
+        tokens = count_tokens(md, client.model)
+        chunks, truncated_tokens = None, 0
+        if tokens > max_input_tokens:
+            chunks = split_into_chunks(md, chunk_tokens, client.model)
+            if len(chunks) > max_chunks:
+                truncated_tokens = sum(count_tokens(chunk, client.model) for chunk in chunks[max_chunks:])
+                logger.info(f"Truncated {post.get('url')} to {max_chunks} of {len(chunks)} chunks")
+                chunks = chunks[:max_chunks]
+        with stats_lock:
+            token_stats['posts'] += 1
+            token_stats['post_tokens'] += original_tokens
+            token_stats['boilerplate_tokens'] += original_tokens - tokens
+            token_stats['truncated_tokens'] += truncated_tokens
+            token_stats['chunked_posts'] += chunks is not None
+        return dict(post, md=md), chunks
 
-        user_prompt_template = Template(configuration.get('user_prompt', ''))
-        user_prompt = user_prompt_template.render(categories=configuration.get('categories', []), post=post)
+    def count_sent(user_prompt, system_prompt):
+        with stats_lock:
+            token_stats['requests'] += 1
+            token_stats['sent_tokens'] += count_tokens(user_prompt, client.model) + count_tokens(system_prompt, client.model)
 
-        system_prompt_template = Template(configuration.get('system_prompt', ''))
-        system_prompt = system_prompt_template.render()
-        
+    def render_chunk_prompts(post, chunks):
+        return [prompts.render_chunk(post, chunk, index, len(chunks)) for index, chunk in enumerate(chunks, start=1)]
+
+    def combine_chunk_summaries(post, responses):
+        # The reduce step summarizes the summaries of the chunks with the regular prompt
+        parts = [f"Part {index}: {response.get('content', '').strip()}" for index, response in enumerate(responses, start=1)]
+        return dict(post, md='\n\n'.join(parts))
+
+    def render_prompts(post):
+        return prompts.render(post)
+
+    def create_result(post, summary, category):
+        return {
+            "url": post.get('url'),
+            "title": post.get('title'),
+            "subtitle": post.get('subtitle'),
+            "domain": post.get('domain'),
+            "date": post.get('date'),
+            "summary": summary,
+            "category": category
+        }
+
+    def strip_code_fence(content):
+        # Remove markdown json code block wrappers if they exist
+        content = content.strip()
+        if content.startswith('```json'):
+            content = content[7:]  # Remove ```json prefix
+        if content.endswith('```'):
+            content = content[:-3]  # Remove ``` suffix
+        return content
+
+    def decode_response(post, response, attempt):
+        """
+        Returns the JSON object answered for a post, None when the output is invalid (counted as a parse failure)
+        """
+        logger.debug(f"Response: {response}")
+        with stats_lock:
+            token_stats['responses'] += 1
+        try:
+            content = json.loads(strip_code_fence(response.get('content', '')))
+            if isinstance(content, dict) and (content.get('error') or (isinstance(content.get('summary'), str)
+                                                                       and isinstance(content.get('category'), str))):
+                return content
+        except json.JSONDecodeError:
+            pass
+        # The invalid output is not kept in the response cache, the next runs ask for a new one
+        client.discard_completion(response)
+        retry = attempt < max_parse_retries
+        with stats_lock:
+            token_stats['invalid_responses'] += 1
+            token_stats['wasted_tokens'] += response.get('tokens_used') or 0
+            token_stats['parse_retries' if retry else 'parse_failed_posts'] += 1
+        logger.error(f"Invalid output for {post.get('url')}{', retrying' if retry else ''}. "
+                     f"Initial content: {response.get('content', '')}")
+        return None
+
+    def parse_response(post, content):
+        if content.get('error'):
+            logger.error(f"Error in response for {post.get('url')}: {content['error']}")
+            return None
+        result = create_result(post, content.get('summary', ''), content.get('category', ''))
+        logger.info(f"Domain: {post.get('domain')} | Url: {post.get('url')} | Summary: {result['summary']}")
+        return result
+
+    def request_summary(post, user_prompt, system_prompt):
+        # Only invalid outputs are retried, a retry is a new request (and cache entry) for the same prompt
+        for attempt in range(max_parse_retries + 1):
+            response = client.generate_completion(
+                prompt=user_prompt,
+                system_prompt=system_prompt,
+                temperature=configuration.get('temperature', 0.7),
+                max_tokens=configuration.get('max_tokens', 500),
+                schema=summary_schema,
+                attempt=attempt
+                )
+            content = decode_response(post, response, attempt)
+            if content is not None:
+                return parse_response(post, content)
+        return None
+
+    async def arequest_summary(post, user_prompt, system_prompt):
+        for attempt in range(max_parse_retries + 1):
+            response = await client.agenerate_completion(
+                prompt=user_prompt,
+                system_prompt=system_prompt,
+                temperature=configuration.get('temperature', 0.7),
+                max_tokens=configuration.get('max_tokens', 500),
+                schema=summary_schema,
+                attempt=attempt
+                )
+            content = decode_response(post, response, attempt)
+            if content is not None:
+                return parse_response(post, content)
+        return None
+
+    def parse_group_response(posts, response):
+        """
+        Maps the items of the JSON array answered for a group of posts back to the posts by URL.
+        Returns a result for every post, None for the posts without a valid item.
+        """
+        logger.debug(f"Response: {response}")
+        with stats_lock:
+            token_stats['responses'] += 1
+        try:
+            items = json.loads(strip_code_fence(response.get('content', '')))
+        except json.JSONDecodeError:
+            logger.warning(f"Failed to parse JSON from the response for a group of {len(posts)} posts")
+            client.discard_completion(response)
+            with stats_lock:
+                token_stats['invalid_responses'] += 1
+                token_stats['wasted_tokens'] += response.get('tokens_used') or 0
+            return [None] * len(posts)
+        if isinstance(items, dict):
+            # Some models wrap the array in an object
+            items = next((value for value in items.values() if isinstance(value, list)), [items])
+        if not isinstance(items, list):
+            items = []
+        by_url = {item['url'].rstrip('/'): item for item in items
+                  if isinstance(item, dict) and isinstance(item.get('url'), str)}
+        results = []
+        for post in posts:
+            item = by_url.get(post['url'].rstrip('/'))
+            if item is None or item.get('error') or not isinstance(item.get('category'), str) \
+                    or not isinstance(item.get('summary'), str) or not item['summary'].strip():
+                logger.warning(f"No valid summary for {post.get('url')} in the response for its group")
+                results.append(None)
+                continue
+            result = create_result(post, item['summary'], item['category'])
+            logger.info(f"Domain: {post.get('domain')} | Url: {post.get('url')} | Summary: {result['summary']}")
+            results.append(result)
+        return results
+
+    def plan_groups(posts):
+        """
+        Packs consecutive short posts into groups summarized by a single request, up to the token budget
+        of the group. Returns the groups as lists of indexes of the posts.
+        """
+        if not group_configuration.get('enabled', False):
+            return [[index] for index in range(len(posts))]
+        budget = min(group_configuration.get('max_input_tokens', 4000), max_input_tokens)
+        max_posts = group_configuration.get('max_posts', 8)
+        groups, current, current_tokens = [], [], 0
+        for index, post in enumerate(posts):
+            tokens = count_tokens(strip_boilerplate(post.get('md') or ''), client.model)
+            if tokens > budget:
+                groups.append([index])
+                continue
+            if current and (current_tokens + tokens > budget or len(current) == max_posts):
+                groups.append(current)
+                current, current_tokens = [], 0
+            current.append(index)
+            current_tokens += tokens
+        if current:
+            groups.append(current)
+        logger.info(f"Packed {len(posts)} posts into {len(groups)} requests")
+        return groups
+
+    def process_group(posts):
+        if len(posts) == 1:
+            return [process_single_post(posts[0])]
+        posts = [prepare_post(post)[0] for post in posts]
+        user_prompt, system_prompt = prompts.render_group(posts)
+        count_sent(user_prompt, system_prompt)
         response = client.generate_completion(
             prompt=user_prompt,
             system_prompt=system_prompt,
             temperature=configuration.get('temperature', 0.7),
-            max_tokens=configuration.get('max_tokens', 500)
+            max_tokens=configuration.get('max_tokens', 500) * len(posts),
+            schema=group_schema
             )
-        logger.debug(f"Response: {response}")
-        
-        try:
-            # Remove markdown json code block wrappers if they exist
-            content = response.get('content', '').strip()
-            if content.startswith('```json'):
-                content = content[7:]  # Remove ```json prefix
-            if content.endswith('```'):
-                content = content[:-3]  # Remove ``` suffix
-            parsed_content = json.loads(content)
-            if 'error' in parsed_content and parsed_content['error'] is not None and parsed_content['error'] != '':
-                logger.error(f"Error in response for {post.get('url')}: {parsed_content['error']}")
-                return None
-            result = create_result(parsed_content.get('summary', ''), parsed_content.get('category', ''))
-            logger.info(f"Domain: {post.get('domain')} | Url: {post.get('url')} | Summary: {result['summary']}")
-            return result
-        except json.JSONDecodeError:
-            logger.error(f"Failed to parse JSON from response for {post.get('url')}. Initial content: {response.get('content', '')}")
-            return None
-    
-    unprocessed_posts = get_recent_unprocessed_posts_by_domain()
-    logger.info(f"Unprocessed posts length: {len(unprocessed_posts)}")
-    summaries = list()
-    logger.info(f"Summary limit: {limit}")
-    for post in unprocessed_posts[:limit] if limit else unprocessed_posts:
-        result = process_single_post(post)
+        results = parse_group_response(posts, response)
+        # The posts without a valid item are summarized on their own
+        for index, post in enumerate(posts):
+            if results[index] is None:
+                with stats_lock:
+                    token_stats['group_fallbacks'] += 1
+                results[index] = summarize_prepared(post, None)
+        return results
+
+    async def aprocess_group(posts):
+        if len(posts) == 1:
+            return [await aprocess_single_post(posts[0])]
+        posts = [prepare_post(post)[0] for post in posts]
+        user_prompt, system_prompt = prompts.render_group(posts)
+        count_sent(user_prompt, system_prompt)
+        response = await client.agenerate_completion(
+            prompt=user_prompt,
+            system_prompt=system_prompt,
+            temperature=configuration.get('temperature', 0.7),
+            max_tokens=configuration.get('max_tokens', 500) * len(posts),
+            schema=group_schema
+            )
+        results = parse_group_response(posts, response)
+        failed = [index for index, result in enumerate(results) if result is None]
+        with stats_lock:
+            token_stats['group_fallbacks'] += len(failed)
+        fallbacks = await asyncio.gather(*[asummarize_prepared(posts[index], None) for index in failed])
+        for index, result in zip(failed, fallbacks):
+            results[index] = result
+        return results
+
+    def process_single_post(post):
+        return summarize_prepared(*prepare_post(post))
+
+    def summarize_prepared(post, chunks):
+        if chunks:
+            responses = []
+            for user_prompt, system_prompt in render_chunk_prompts(post, chunks):
+                count_sent(user_prompt, system_prompt)
+                responses.append(client.generate_completion(
+                    prompt=user_prompt,
+                    system_prompt=system_prompt,
+                    temperature=configuration.get('temperature', 0.7),
+                    max_tokens=chunk_summary_tokens
+                    ))
+            post = combine_chunk_summaries(post, responses)
+        user_prompt, system_prompt = render_prompts(post)
+        count_sent(user_prompt, system_prompt)
+        return request_summary(post, user_prompt, system_prompt)
+
+    async def aprocess_single_post(post):
+        return await asummarize_prepared(*prepare_post(post))
+
+    async def asummarize_prepared(post, chunks):
+        if chunks:
+            # The chunks of a post are summarized concurrently
+            requests = []
+            for user_prompt, system_prompt in render_chunk_prompts(post, chunks):
+                count_sent(user_prompt, system_prompt)
+                requests.append(client.agenerate_completion(
+                    prompt=user_prompt,
+                    system_prompt=system_prompt,
+                    temperature=configuration.get('temperature', 0.7),
+                    max_tokens=chunk_summary_tokens
+                    ))
+            post = combine_chunk_summaries(post, await asyncio.gather(*requests))
+        user_prompt, system_prompt = render_prompts(post)
+        count_sent(user_prompt, system_prompt)
+        return await arequest_summary(post, user_prompt, system_prompt)
+
+    def collect_result(results, index, result):
         if result:
-            summaries.append(result)
+            results[index] = result
             save_summary_to_db(result)
 
+    def summarize_with_threads(posts, workers):
+        # Results are kept in the order of the posts, so summaries.json does not depend on completion order
+        results = [None] * len(posts)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='summarizer') as pool:
+            futures = {pool.submit(process_group, [posts[index] for index in group]): group
+                       for group in plan_groups(posts)}
+            for future in as_completed(futures):
+                group = futures[future]
+                try:
+                    for index, result in zip(group, future.result()):
+                        collect_result(results, index, result)
+                except Exception as e:
+                    logger.error(f"Error summarizing {', '.join(posts[index].get('url') for index in group)}: {e}")
+        return results
+
+    async def summarize_with_asyncio(posts, workers):
+        # A single event loop keeps up to `workers` requests in flight over the pooled connections
+        results = [None] * len(posts)
+        semaphore = asyncio.Semaphore(workers)
+
+        async def summarize(group):
+            async with semaphore:
+                try:
+                    return group, await aprocess_group([posts[index] for index in group])
+                except Exception as e:
+                    logger.error(f"Error summarizing {', '.join(posts[index].get('url') for index in group)}: {e}")
+                    return group, [None] * len(group)
+
+        try:
+            for task in asyncio.as_completed([summarize(group) for group in plan_groups(posts)]):
+                group, group_results = await task
+                for index, result in zip(group, group_results):
+                    collect_result(results, index, result)
+        finally:
+            await client.aclose()
+        return results
+
+    def summarize_from_queue(post_queue, workers):
+        # At most `workers` posts are taken from the queue at a time, so its bound holds back the scraper
+        results, urls, skipped, taken = [], [], 0, 0
+        in_flight = dict()
+
+        def collect(done):
+            for future in done:
+                index = in_flight.pop(future)
+                try:
+                    collect_result(results, index, future.result())
+                except Exception as e:
+                    logger.error(f"Error summarizing {urls[index]}: {e}")
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='summarizer') as pool:
+            while True:
+                post = post_queue.get()
+                if post is None:
+                    break
+                if limit and len(urls) >= limit:
+                    # The queue is still drained, the posts over the limit are left for the next run
+                    skipped += 1
+                    continue
+                claimed = claim_posts_by_url(owner, [post['url']], lease_seconds, max_attempts)
+                if not claimed:
+                    taken += 1
+                    continue
+                post = claimed[0]
+                while len(in_flight) >= workers:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                urls.append(post['url'])
+                results.append(None)
+                in_flight[pool.submit(process_single_post, post)] = len(urls) - 1
+            collect(wait(in_flight).done)
+        if skipped:
+            logger.info(f"{skipped} scraped posts over the limit are left for the next run")
+        if taken:
+            logger.info(f"{taken} scraped posts were already claimed by another summarizer")
+        return results, urls
+
+    def summarize_with_batch(posts):
+        # Short posts and the chunks of the long ones go in a first batch, the long posts are summarized
+        # from their chunk summaries in a second one
+        options = dict(batch_configuration)
+        api = FakeBatchAPI() if options.pop('provider', 'openai') == 'fake' else client.batch_api()
+        options.pop('enabled', None)
+        runner = BatchRunner(api, os.path.join(os.path.dirname(summaries_file) or '.', 'batches'), **options)
+        temperature = configuration.get('temperature', 0.7)
+        max_tokens = configuration.get('max_tokens', 500)
+
+        prepared = [prepare_post(post) for post in posts]
+        requests = {}
+        for post, chunks in prepared:
+            if chunks:
+                for index, (user_prompt, system_prompt) in enumerate(render_chunk_prompts(post, chunks), start=1):
+                    requests[f"{post['url']}#chunk-{index}"] = (user_prompt, system_prompt, chunk_summary_tokens, None)
+            else:
+                user_prompt, system_prompt = render_prompts(post)
+                requests[post['url']] = (user_prompt, system_prompt, max_tokens, summary_schema)
+        for user_prompt, system_prompt, _, _ in requests.values():
+            count_sent(user_prompt, system_prompt)
+        responses = client.generate_batch(requests, runner, temperature)
+
+        reduce_requests = {}
+        for post, chunks in prepared:
+            if chunks:
+                chunk_responses = [responses.get(f"{post['url']}#chunk-{index}") for index in range(1, len(chunks) + 1)]
+                if None in chunk_responses:
+                    logger.error(f"Missing chunk summaries for {post['url']}, it is left for the next run")
+                    continue
+                user_prompt, system_prompt = render_prompts(combine_chunk_summaries(post, chunk_responses))
+                count_sent(user_prompt, system_prompt)
+                reduce_requests[post['url']] = (user_prompt, system_prompt, max_tokens, summary_schema)
+        if reduce_requests:
+            responses.update(client.generate_batch(reduce_requests, runner, temperature))
+
+        # Invalid outputs are not retried in batch, their posts are left for the next run
+        results = [None] * len(posts)
+        for index, (post, _) in enumerate(prepared):
+            if post['url'] in responses:
+                content = decode_response(post, responses[post['url']], max_parse_retries)
+                if content is not None:
+                    collect_result(results, index, parse_response(post, content))
+        return results
+
+    def log_token_stats():
+        saved = token_stats['boilerplate_tokens'] + token_stats['truncated_tokens']
+        saved_ratio = saved / token_stats['post_tokens'] * 100 if token_stats['post_tokens'] else 0
+        logger.info(f"Input tokens: {token_stats['sent_tokens']} sent for {token_stats['posts']} posts of "
+                    f"{token_stats['post_tokens']} tokens, {saved} saved ({saved_ratio:.0f}%): "
+                    f"{token_stats['boilerplate_tokens']} of boilerplate and {token_stats['truncated_tokens']} truncated, "
+                    f"{token_stats['chunked_posts']} posts summarized in chunks, {token_stats['requests']} requests")
+        if group_configuration.get('enabled', False):
+            logger.info(f"{token_stats['group_fallbacks']} posts of groups were summarized again on their own")
+        failure_rate = token_stats['invalid_responses'] / token_stats['responses'] * 100 if token_stats['responses'] else 0
+        logger.info(f"Parse failures: {token_stats['invalid_responses']} of {token_stats['responses']} responses "
+                    f"({failure_rate:.1f}%), {token_stats['parse_retries']} retried, "
+                    f"{token_stats['parse_failed_posts']} posts without a valid summary, "
+                    f"{token_stats['wasted_tokens']} tokens spent on invalid outputs")
+
+    budget = configuration.get('summarize_budget', {})
+    max_input_tokens = budget.get('max_input_tokens', 6000)
+    chunk_tokens = budget.get('chunk_tokens', 3000)
+    max_chunks = budget.get('max_chunks', 8)
+    chunk_summary_tokens = budget.get('chunk_summary_tokens', 300)
+    prompts = PromptRenderer(configuration, os.path.join(os.path.dirname(summaries_file) or '.', 'jinja_cache'))
+    token_stats = Counter()
+    stats_lock = threading.Lock()
+    batch_configuration = configuration.get('summarize_batch', {})
+    group_configuration = configuration.get('summarize_group', {})
+    structured_output = configuration.get('structured_output', {})
+    max_parse_retries = max(0, structured_output.get('max_retries', 1))
+    # The JSON schemas constrain the outputs with the structured output mode of the provider
+    summary_schema = prompts.summary_schema if structured_output.get('enabled', True) else None
+    group_schema = prompts.group_schema if structured_output.get('enabled', True) else None
+
+    work_queue = configuration.get('work_queue', {})
+    max_attempts = work_queue.get('max_attempts', 3)
+    lease_seconds = work_queue.get('lease_minutes', 60) * 60
+    if post_queue is None and batch_configuration.get('enabled', False):
+        # The posts stay claimed while their batches may run
+        lease_seconds += batch_configuration.get('timeout_hours', 24) * 3600
+    # Identifies the claims of this run among the summarizers sharing the database
+    owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    workers = max(1, configuration.get('summarize_workers', 1))
+    if post_queue is not None:
+        # The queued posts come one at a time, they are not grouped nor sent to the Batch API
+        ignored = [name for name, enabled in (('summarize_batch', batch_configuration.get('enabled', False)),
+                                              ('summarize_async', configuration.get('summarize_async', False)),
+                                              ('summarize_group', group_configuration.get('enabled', False)))
+                   if enabled]
+        if ignored:
+            logger.warning(f"The pipeline summarizes the posts one at a time with worker threads, "
+                           f"{', '.join(ignored)} {'is' if len(ignored) == 1 else 'are'} ignored")
+        logger.info(f"Summarizing the scraped posts as they come with {workers} workers, limit: {limit}")
+        results, urls = summarize_from_queue(post_queue, workers)
+    else:
+        logger.info(f"Summary limit: {limit}")
+        posts_to_process = claim_recent_posts(owner, limit, lease_seconds=lease_seconds, max_attempts=max_attempts)
+        urls = [post['url'] for post in posts_to_process]
+        if batch_configuration.get('enabled', False):
+            logger.info(f"Summarizing {len(posts_to_process)} posts in batch")
+            results = summarize_with_batch(posts_to_process)
+        elif configuration.get('summarize_async', False):
+            logger.info(f"Summarizing {len(posts_to_process)} posts with up to {workers} concurrent requests on asyncio")
+            results = asyncio.run(summarize_with_asyncio(posts_to_process, workers))
+        else:
+            logger.info(f"Summarizing {len(posts_to_process)} posts with {workers} workers")
+            results = summarize_with_threads(posts_to_process, workers)
+    summaries = [result for result in results if result]
+    log_token_stats()
+    if client.cache is not None:
+        client.cache.log_stats()
+
     # Restructure summaries into a category bag
     category_bag = restructure_summaries(summaries)
     # Replace the original summaries list with the category bag
-    urls_to_mark = [post['url'] for post in unprocessed_posts]
-    mark_posts_as_processed(urls_to_mark)
+    mark_posts_as_processed([url for url, result in zip(urls, results) if result])
+    mark_posts_as_failed(owner, [url for url, result in zip(urls, results) if not result])
     filtered_category_bag = filter_invalid_summaries(category_bag)
     
     # Write the filtered category bag to summaries.json
@@ -0,0 +1,169 @@
+import json
+import logging
+import os
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+ENDPOINT = '/v1/chat/completions'
+TERMINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+# A cancelled batch goes through 'cancelling' (up to 10 minutes) before its output file is available
+CANCEL_TIMEOUT = 15 * 60
+
+
+class BatchRunner:
+    """
+    Runs chat completion requests through a Batch API: the request bodies are written to JSONL files,
+    submitted, polled until the batches are over, and the responses are mapped back by custom_id.
+    `api` is an OpenAI client, or a FakeBatchAPI for local runs.
+    """
+    def __init__(self, api: Any, work_dir: str, poll_interval: float = 30, timeout_hours: float = 24,
+                 completion_window: str = '24h', max_requests_per_batch: int = 50000):
+        self.api = api
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.timeout = timeout_hours * 3600
+        self.completion_window = completion_window
+        self.max_requests_per_batch = max_requests_per_batch
+        os.makedirs(work_dir, exist_ok=True)
+
+    def write_batch_file(self, bodies: Dict[str, dict], path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            for custom_id, body in bodies.items():
+                f.write(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': ENDPOINT, 'body': body},
+                                   ensure_ascii=False) + '\n')
+
+    def submit(self, path: str) -> str:
+        with open(path, 'rb') as f:
+            batch_file = self.api.files.create(file=f, purpose='batch')
+        batch = self.api.batches.create(input_file_id=batch_file.id, endpoint=ENDPOINT,
+                                        completion_window=self.completion_window)
+        logger.info(f"Submitted batch {batch.id} from {path}")
+        return batch.id
+
+    def wait(self, batch_ids: List[str]) -> List[Any]:
+        """
+        Polls the batches until they are all over or the timeout is reached, the unfinished ones are cancelled
+        and polled until the cancellation is over, so the responses completed in time are returned with them
+        """
+        deadline = time.monotonic() + self.timeout
+        pending, finished, cancelled = list(batch_ids), [], False
+        while pending:
+            for batch_id in list(pending):
+                batch = self.api.batches.retrieve(batch_id)
+                if batch.status in TERMINAL_STATUSES:
+                    logger.info(f"Batch {batch_id} {batch.status}: {batch.request_counts}")
+                    finished.append(batch)
+                    pending.remove(batch_id)
+            if not pending:
+                break
+            if time.monotonic() > deadline:
+                if cancelled:
+                    for batch_id in pending:
+                        logger.error(f"Batch {batch_id} was not cancelled in time, its responses are dropped")
+                    break
+                for batch_id in pending:
+                    logger.error(f"Batch {batch_id} did not complete in time, cancelling it")
+                    self.api.batches.cancel(batch_id)
+                deadline, cancelled = time.monotonic() + CANCEL_TIMEOUT, True
+            logger.debug(f"Waiting for {len(pending)} batches")
+            time.sleep(self.poll_interval)
+        return finished
+
+    def read_results(self, batch: Any) -> Iterator[dict]:
+        # Expired and cancelled batches still hold the responses completed in time
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                for line in self.api.files.content(file_id).text.splitlines():
+                    if line.strip():
+                        yield json.loads(line)
+
+    def run(self, bodies: Dict[str, dict]) -> Dict[str, dict]:
+        """
+        Runs the request bodies, keyed by custom_id, and returns the bodies of the successful responses by custom_id
+        """
+        custom_ids = list(bodies)
+        batch_ids = []
+        for start in range(0, len(custom_ids), self.max_requests_per_batch):
+            path = os.path.join(self.work_dir, f"batch-{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.jsonl")
+            self.write_batch_file({custom_id: bodies[custom_id]
+                                   for custom_id in custom_ids[start:start + self.max_requests_per_batch]}, path)
+            batch_ids.append(self.submit(path))
+
+        responses = {}
+        for batch in self.wait(batch_ids):
+            for result in self.read_results(batch):
+                response = result.get('response') or {}
+                if result.get('error') or response.get('status_code') != 200:
+                    logger.error(f"Batch request {result.get('custom_id')} failed: {result.get('error') or response}")
+                    continue
+                responses[result['custom_id']] = response['body']
+        missing = len(bodies) - len(responses)
+        if missing:
+            logger.warning(f"{missing} of {len(bodies)} batch requests have no response")
+        return responses
+
+
+def fake_completion(body: dict) -> str:
+    """
+    Answers a summarization request with a valid summary made of the start of the prompt
+    """
+    prompt = body['messages'][-1]['content']
+    return json.dumps({'summary': prompt[:200], 'category': 'uncategorized'})
+
+
+class FakeBatchAPI:
+    """
+    Local stand-in for the files and batches endpoints of the OpenAI client, for tests and dry runs.
+    Batches complete immediately, every request is answered by `respond(body)`.
+    """
+    provider = 'fake'  # keeps its answers apart from the real ones in the response cache
+
+    def __init__(self, respond: Callable[[dict], str] = fake_completion):
+        self.respond = respond
+        self._files: Dict[str, str] = {}
+        self._batches: Dict[str, SimpleNamespace] = {}
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._batches.__getitem__,
+                                       cancel=self._cancel_batch)
+
+    def _create_file(self, file, purpose: str) -> SimpleNamespace:
+        file_id = f'file-{uuid.uuid4().hex}'
+        content = file.read()
+        self._files[file_id] = content.decode('utf-8') if isinstance(content, bytes) else content
+        return SimpleNamespace(id=file_id, purpose=purpose)
+
+    def _file_content(self, file_id: str) -> SimpleNamespace:
+        return SimpleNamespace(text=self._files[file_id])
+
+    def _answer(self, request: dict) -> dict:
+        content = self.respond(request['body'])
+        tokens = (sum(len(message['content']) for message in request['body']['messages']) + len(content)) // 4
+        return {
+            'id': f'batch_req_{uuid.uuid4().hex}',
+            'custom_id': request['custom_id'],
+            'response': {'status_code': 200, 'body': {
+                'model': request['body']['model'],
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': {'total_tokens': tokens},
+            }},
+            'error': None,
+        }
+
+    def _create_batch(self, input_file_id: str, endpoint: str, completion_window: str) -> SimpleNamespace:
+        requests = [json.loads(line) for line in self._files[input_file_id].splitlines() if line.strip()]
+        output = ''.join(json.dumps(self._answer(request)) + '\n' for request in requests)
+        output_file_id = self._create_file(SimpleNamespace(read=lambda: output), 'batch_output').id
+        batch = SimpleNamespace(id=f'batch_{uuid.uuid4().hex}', status='completed', endpoint=endpoint,
+                                input_file_id=input_file_id, output_file_id=output_file_id, error_file_id=None,
+                                request_counts={'total': len(requests), 'completed': len(requests), 'failed': 0})
+        self._batches[batch.id] = batch
+        return batch
+
+    def _cancel_batch(self, batch_id: str) -> SimpleNamespace:
+        batch = self._batches[batch_id]
+        batch.status = 'cancelled'
+        return batch
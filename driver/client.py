@@ -1,130 +1,347 @@
 import os
+import asyncio
 import logging
-import time
-from openai import OpenAI
+import openai
+from openai import OpenAI, AsyncOpenAI
+import httpx
 import requests
-from typing import Callable, Dict, Optional
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from typing import Any, Awaitable, Callable, Dict, Optional
 import json
+from driver.batch import BatchRunner
+from driver.ratelimit import RateLimiter
+from driver.utils.jsonstream import JsonObjectTracker
+from driver.utils.responsecache import ResponseCache
+from driver.utils.tokens import count_tokens
 logger = logging.getLogger(__name__)
 
-# Type alias for completion strategy functions
-CompletionStrategy = Callable[[str, Optional[str], float, int], Dict[str, any]]
+# Type alias for completion strategy functions: prompt, system_prompt, temperature, max_tokens, schema, attempt
+CompletionStrategy = Callable[[str, Optional[str], float, int, Optional[dict], int], Dict[str, any]]
+# Type alias for the asyncio counterparts of the completion strategy functions
+AsyncCompletionStrategy = Callable[[str, Optional[str], float, int, Optional[dict], int], Awaitable[Dict[str, any]]]
+# Errors after which the request is retried, once the limiter has paused for the advertised Retry-After
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class OllamaStream:
+    """
+    Accumulates a streamed Ollama completion. It is over when Ollama says so,
+    or as soon as the JSON object the completion starts with is complete.
+    """
+    def __init__(self):
+        self.parts = []
+        self.tokens_used = None
+        self.tracker = JsonObjectTracker()
+
+    def feed(self, line: str | bytes) -> bool:
+        """Consumes a line of the stream, returns True when the rest of the stream is not needed"""
+        if not line or not line.strip():
+            return False
+        try:
+            chunk = json.loads(line)
+        except json.JSONDecodeError:
+            logger.warning(f"Failed to parse response chunk: {line}")
+            return False
+        if chunk.get('error'):
+            raise RuntimeError(f"Ollama error: {chunk['error']}")
+        text = chunk.get('response', '')
+        self.parts.append(text)
+        if chunk.get('done'):
+            self.tokens_used = chunk.get('prompt_eval_count', 0) + chunk.get('eval_count', 0)
+            return True
+        if self.tracker.feed(text):
+            logger.debug(f"JSON object complete after {len(self.parts)} chunks, closing the stream")
+            return True
+        return False
+
+    def result(self) -> dict:
+        content = ''.join(self.parts)
+        if self.tracker.complete:
+            # The chunk closing the object can go on with more text (a closing fence, a comment), it is cut off
+            content = content[:self.tracker.end]
+        logger.debug(f'Response: {content}')
+        # Ollama only reports the token counts in the last chunk, which is not read when the stream is cut short
+        return {'content': content, 'tokens_used': self.tokens_used}
 
 class AIClient:
-    def __init__(self, client_type='ollama', model=None):
+    def __init__(self, client_type='ollama', model=None, max_connections=100, cache: Optional[ResponseCache] = None,
+                 rate_limits: Optional[dict] = None, max_retries: int = 3, ollama_format: str = 'schema'):
         """Initialize AI client wrapper for either OpenAI or Ollama
 
         Args:
             client_type (str): Type of client - 'ollama' or 'openai'
             model (str): Model name to use
+            max_connections (int): Size of the keep-alive connection pool to the provider
+            cache (ResponseCache, optional): Persistent cache checked before calling the provider
+            rate_limits (dict, optional): Requests and tokens per minute by model name, with a "default" entry
+            max_retries (int): Retries of a request rejected with 429 or a server error
+            ollama_format (str): 'schema' sends the JSON schemas as the Ollama format (Ollama 0.5 or later),
+                'json' only asks for JSON (older Ollama versions)
         """
         if model is not None:
             self.model = model
-        
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.ollama_format = ollama_format
+        self.cache = cache
+        self.client_type = client_type.lower()
+        self.limiter: Optional[RateLimiter] = None  # local Ollama models are not rate limited
+        self._batch_api = None
+        # asyncio HTTP clients are bound to the event loop they were created in
+        self._async_clients: Dict[asyncio.AbstractEventLoop, Any] = {}
+
         match client_type.lower():
             case 'openai':
                 try:
                     api_key = os.environ["OPENAI_API_KEY"]
                     if not hasattr(self, 'model') or self.model is None:
                         self.model = 'gpt-4o'
-                    client = OpenAI(api_key=api_key)
-                    self.strategy = self._create_openai_strategy(client)
+                    # Retries are driven by the limiter, which pauses every worker on Retry-After
+                    client = OpenAI(api_key=api_key, max_retries=0)
+                    self._batch_api = client
+                    # One limiter for the sync and asyncio strategies, shared by all the workers
+                    self.limiter = RateLimiter.for_model(self.model, rate_limits)
+                    self.strategy = self._create_openai_strategy(client, self.limiter)
+                    self.async_strategy = self._create_async_openai_strategy(
+                        lambda: AsyncOpenAI(api_key=api_key, max_retries=0,
+                                            http_client=httpx.AsyncClient(limits=self._http_limits())),
+                        self.limiter)
                 except KeyError:
                     raise ValueError("OPENAI_API_KEY environment variable must be set for OpenAI client")
             case 'ollama':
                 if not hasattr(self, 'model') or self.model is None:
                     self.model = 'llama3.1'
                 self.strategy = self._create_ollama_strategy("http://localhost:11434/api")
+                self.async_strategy = self._create_async_ollama_strategy("http://localhost:11434/api")
             case _:
                 raise ValueError(f"Unsupported client type: {client_type}")
+        if cache is not None:
+            self.strategy = self._with_cache(client_type.lower(), self.strategy)
+            self.async_strategy = self._with_async_cache(client_type.lower(), self.async_strategy)
+
+    def _cache_key(self, provider: str, prompt: str, system_prompt: Optional[str], temperature: float,
+                   max_tokens: int, schema: Optional[dict], attempt: int) -> str:
+        # Retries of an invalid output are cached apart from the first attempt
+        extra = dict()
+        if schema is not None:
+            extra['schema'] = schema
+        if attempt:
+            extra['attempt'] = attempt
+        return ResponseCache.key(provider, self.model, prompt, system_prompt, temperature, max_tokens, **extra)
+
+    def _with_cache(self, provider: str, strategy: CompletionStrategy) -> CompletionStrategy:
+        """Wraps a completion strategy, so cached completions are returned without calling the provider"""
+        def generate(prompt: str, system_prompt: str = None, temperature: float = 0.7, max_tokens: int = 500,
+                     schema: Optional[dict] = None, attempt: int = 0) -> dict:
+            key = self._cache_key(provider, prompt, system_prompt, temperature, max_tokens, schema, attempt)
+            cached = self.cache.get(key)
+            if cached is not None:
+                logger.info(f"Returning cached completion of {self.model}")
+                return dict(cached, cache_key=key)
+            response = strategy(prompt, system_prompt, temperature, max_tokens, schema, attempt)
+            self.cache.put(key, self.model, response)
+            return dict(response, cache_key=key)
+
+        return generate
+
+    def _with_async_cache(self, provider: str, strategy: AsyncCompletionStrategy) -> AsyncCompletionStrategy:
+        """Wraps an asyncio completion strategy, so cached completions are returned without calling the provider"""
+        async def generate(prompt: str, system_prompt: str = None, temperature: float = 0.7, max_tokens: int = 500,
+                           schema: Optional[dict] = None, attempt: int = 0) -> dict:
+            key = self._cache_key(provider, prompt, system_prompt, temperature, max_tokens, schema, attempt)
+            # The cache reads and writes the disk (and evicts now and then), off the event loop
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                logger.info(f"Returning cached completion of {self.model}")
+                return dict(cached, cache_key=key)
+            response = await strategy(prompt, system_prompt, temperature, max_tokens, schema, attempt)
+            await asyncio.to_thread(self.cache.put, key, self.model, response)
+            return dict(response, cache_key=key)
+
+        return generate
+
+    def _http_limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+
+    def _async_client(self, factory: Callable[[], Any]) -> Any:
+        """Returns the asyncio client of the running event loop, created by factory on first use"""
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_clients:
+            self._async_clients[loop] = factory()
+        return self._async_clients[loop]
+
+    @staticmethod
+    def _openai_options(schema: Optional[dict]) -> dict:
+        """Structured output options of a request, the reply is constrained to the JSON schema"""
+        if schema is None:
+            return dict()
+        return {'response_format': {'type': 'json_schema',
+                                    'json_schema': {'name': 'response', 'schema': schema, 'strict': True}}}
+
+    @staticmethod
+    def _openai_messages(prompt: str, system_prompt: Optional[str]) -> list:
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": prompt})
+        return messages
+
+    def _estimate_request_tokens(self, prompt: str, system_prompt: Optional[str], max_tokens: int) -> int:
+        # Providers count max_tokens against the tokens/min limit when the request is admitted
+        return count_tokens(prompt, self.model) + count_tokens(system_prompt, self.model) + max_tokens
 
-    def _create_openai_strategy(self, client: OpenAI) -> CompletionStrategy:
+    @staticmethod
+    def _retry_after(error: Exception, retry: int) -> float:
+        """Seconds to back off after a rejected request, from the Retry-After headers when the provider sends them"""
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        try:
+            if 'retry-after-ms' in headers:
+                return float(headers['retry-after-ms']) / 1000
+            if 'retry-after' in headers:
+                return float(headers['retry-after'])
+        except ValueError:
+            pass
+        return min(60.0, 2 ** retry)
+
+    def _create_openai_strategy(self, client: OpenAI, limiter: RateLimiter) -> CompletionStrategy:
         """Creates an OpenAI completion strategy function"""
-        def _apply_rate_limiting(tokens_used: int):
-            # Initialize rate limiting state if not exists
-            if not hasattr(self, '_last_request_time'):
-                self._last_request_time = datetime.now()
-                self._token_bucket = 10000  # Max bucket size
-            
-            # Calculate tokens to add based on time elapsed
-            now = datetime.now()
-            time_elapsed = (now - self._last_request_time).total_seconds()
-            tokens_to_add = time_elapsed * (10000 / 60)  # Refill rate: 10k tokens/min
-            
-            self._token_bucket = min(10000, self._token_bucket + tokens_to_add)
-            
-            # Wait if needed
-            if self._token_bucket < tokens_used:
-                wait_time = (tokens_used - self._token_bucket) * (60 / 10000)
-                logger.info(f"Rate limit reached. Waiting {wait_time:.2f} seconds")
-                time.sleep(wait_time)
-                self._token_bucket = 10000
-            
-            # Update state
-            self._token_bucket -= tokens_used
-            self._last_request_time = now
-            
-        def generate(prompt: str, system_prompt: str = None, 
-                    temperature: float = 0.7, max_tokens: int = 500) -> dict:
+        def generate(prompt: str, system_prompt: str = None, temperature: float = 0.7, max_tokens: int = 500,
+                     schema: Optional[dict] = None, attempt: int = 0) -> dict:
             logger.info(f"Generating completion with OPENAI and model {self.model}")
-            messages = []
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
-            messages.append({"role": "user", "content": prompt})
-            
-            response = client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens
-            )
-            _apply_rate_limiting(response.usage.total_tokens)
-            return {
-                'content': response.choices[0].message.content,
-                'tokens_used': response.usage.total_tokens
-            }
-        
+            for retry in range(self.max_retries + 1):
+                reservation = limiter.acquire(self._estimate_request_tokens(prompt, system_prompt, max_tokens))
+                try:
+                    response = client.chat.completions.create(
+                        model=self.model,
+                        messages=self._openai_messages(prompt, system_prompt),
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        **self._openai_options(schema)
+                    )
+                except RETRYABLE_ERRORS as e:
+                    # A rejected request does not consume tokens
+                    limiter.reconcile(reservation, 0)
+                    if retry == self.max_retries:
+                        raise
+                    limiter.pause(self._retry_after(e, retry))
+                    continue
+                except BaseException:
+                    # Nor does a failed one (bad request, authentication, interrupted call), give the tokens back
+                    limiter.reconcile(reservation, 0)
+                    raise
+                limiter.reconcile(reservation, response.usage.total_tokens)
+                return {
+                    'content': response.choices[0].message.content,
+                    'tokens_used': response.usage.total_tokens
+                }
+
+        return generate
+
+    def _create_async_openai_strategy(self, factory: Callable[[], AsyncOpenAI],
+                                      limiter: RateLimiter) -> AsyncCompletionStrategy:
+        """Creates an asyncio OpenAI completion strategy function"""
+        async def generate(prompt: str, system_prompt: str = None, temperature: float = 0.7, max_tokens: int = 500,
+                           schema: Optional[dict] = None, attempt: int = 0) -> dict:
+            logger.info(f"Generating completion with OPENAI and model {self.model}")
+            client = self._async_client(factory)
+            for retry in range(self.max_retries + 1):
+                reservation = await limiter.aacquire(self._estimate_request_tokens(prompt, system_prompt, max_tokens))
+                try:
+                    response = await client.chat.completions.create(
+                        model=self.model,
+                        messages=self._openai_messages(prompt, system_prompt),
+                        temperature=temperature,
+                        max_tokens=max_tokens,
+                        **self._openai_options(schema)
+                    )
+                except RETRYABLE_ERRORS as e:
+                    limiter.reconcile(reservation, 0)
+                    if retry == self.max_retries:
+                        raise
+                    limiter.pause(self._retry_after(e, retry))
+                    continue
+                except BaseException:
+                    # Including the cancellation of the task
+                    limiter.reconcile(reservation, 0)
+                    raise
+                limiter.reconcile(reservation, response.usage.total_tokens)
+                return {
+                    'content': response.choices[0].message.content,
+                    'tokens_used': response.usage.total_tokens
+                }
+
         return generate
 
+    def _ollama_payload(self, prompt: str, system_prompt: Optional[str], temperature: float, max_tokens: int,
+                        schema: Optional[dict]) -> dict:
+        payload = {
+            'model': self.model,
+            'prompt': prompt,
+            'system': system_prompt if system_prompt else '',
+            'stream': True,
+            'options': {
+                'temperature': temperature,
+                'num_predict': max_tokens
+            }
+        }
+        if schema is not None:
+            # Constrains the reply to the JSON schema, or only to JSON before Ollama 0.5
+            payload['format'] = schema if self.ollama_format == 'schema' else 'json'
+        return payload
+
     def _create_ollama_strategy(self, base_url: str) -> CompletionStrategy:
         """Creates an Ollama completion strategy function"""
-        def generate(prompt: str, system_prompt: str = None, 
-                    temperature: float = 0.7, max_tokens: int = 500) -> dict:
+        # Keep-alive connections are reused across the calls (and the summarization workers)
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections))
+        session.headers.update({'Content-Type': 'application/json'})
+
+        def generate(prompt: str, system_prompt: str = None, temperature: float = 0.7, max_tokens: int = 500,
+                     schema: Optional[dict] = None, attempt: int = 0) -> dict:
             logger.info(f"Generating completion with OLLAMA and model {self.model}")
             logger.debug(f'System prompt: {system_prompt}')
             logger.debug(f'User prompt: {prompt}')
-            payload = {
-                'model': self.model,
-                'prompt': prompt,
-                'system': system_prompt if system_prompt else '',
-                'temperature': temperature
-            }
-            
-            response = requests.post(f"{base_url}/generate", json=payload, headers={'Content-Type': 'application/json'})
-            response.raise_for_status()
-            logger.debug(f'Response: {response.text}')
-            # Combine all response chunks
-            full_response = ""
-            for line in response.text.strip().split('\n'):
-                if line.strip():
-                    try:
-                        chunk = json.loads(line)
-                        full_response += chunk.get('response', '')
-                    except json.JSONDecodeError as e:
-                        logger.warning(f"Failed to parse response chunk: {line}")
-                        continue
-            
-            return {
-                'content': full_response,
-                'tokens_used': None  # Ollama doesn't provide token count
-            }
-        
+            payload = self._ollama_payload(prompt, system_prompt, temperature, max_tokens, schema)
+
+            stream = OllamaStream()
+            # Leaving the block early closes the connection, which stops the generation
+            with session.post(f"{base_url}/generate", json=payload, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if stream.feed(line):
+                        break
+            return stream.result()
+
         return generate
 
+    def _create_async_ollama_strategy(self, base_url: str) -> AsyncCompletionStrategy:
+        """Creates an asyncio Ollama completion strategy function"""
+        def factory() -> httpx.AsyncClient:
+            return httpx.AsyncClient(base_url=base_url, limits=self._http_limits(),
+                                     timeout=httpx.Timeout(300.0, connect=10.0),
+                                     headers={'Content-Type': 'application/json'})
 
-    def generate_completion(self, prompt: str, system_prompt: str = None, 
-                          temperature: float = 0.7, max_tokens: int = 500) -> dict:
+        async def generate(prompt: str, system_prompt: str = None, temperature: float = 0.7, max_tokens: int = 500,
+                           schema: Optional[dict] = None, attempt: int = 0) -> dict:
+            logger.info(f"Generating completion with OLLAMA and model {self.model}")
+            logger.debug(f'System prompt: {system_prompt}')
+            logger.debug(f'User prompt: {prompt}')
+            payload = self._ollama_payload(prompt, system_prompt, temperature, max_tokens, schema)
+
+            stream = OllamaStream()
+            async with self._async_client(factory).stream("POST", "/generate", json=payload) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if stream.feed(line):
+                        break
+            return stream.result()
+
+        return generate
+
+
+    def generate_completion(self, prompt: str, system_prompt: str = None,
+                          temperature: float = 0.7, max_tokens: int = 500,
+                          schema: Optional[dict] = None, attempt: int = 0) -> dict:
         """Generate completion for given prompt
 
         Args:
@@ -132,15 +349,99 @@ class AIClient:
             system_prompt (str, optional): System prompt for context
             temperature (float, optional): Sampling temperature
             max_tokens (int, optional): Maximum tokens in response
+            schema (dict, optional): JSON schema the response must follow, with the provider's structured output mode
+            attempt (int, optional): Retry number of the same request after an invalid output
+
+        Returns:
+            dict: Response containing generated text and metadata
+        """
+        try:
+            return self.strategy(prompt, system_prompt, temperature, max_tokens, schema, attempt)
+        except Exception as e:
+            logger.error(f"Error generating completion: {str(e)}")
+            raise
+
+    async def agenerate_completion(self, prompt: str, system_prompt: str = None,
+                                   temperature: float = 0.7, max_tokens: int = 500,
+                                   schema: Optional[dict] = None, attempt: int = 0) -> dict:
+        """Generate completion for given prompt without blocking the event loop
+
+        Args:
+            prompt (str): The prompt to generate completion for
+            system_prompt (str, optional): System prompt for context
+            temperature (float, optional): Sampling temperature
+            max_tokens (int, optional): Maximum tokens in response
+            schema (dict, optional): JSON schema the response must follow, with the provider's structured output mode
+            attempt (int, optional): Retry number of the same request after an invalid output
 
         Returns:
             dict: Response containing generated text and metadata
         """
         try:
-            return self.strategy(prompt, system_prompt, temperature, max_tokens)
+            return await self.async_strategy(prompt, system_prompt, temperature, max_tokens, schema, attempt)
         except Exception as e:
             logger.error(f"Error generating completion: {str(e)}")
             raise
 
+    def batch_api(self) -> Any:
+        """Returns the client of the provider's Batch API"""
+        if self._batch_api is None:
+            raise ValueError(f"The {self.client_type} client does not support batch summarization")
+        return self._batch_api
+
+    def generate_batch(self, requests: Dict[str, tuple], runner: BatchRunner,
+                       temperature: float = 0.7) -> Dict[str, dict]:
+        """Generate completions for many prompts at once through a Batch API
+
+        Args:
+            requests (dict): (prompt, system_prompt, max_tokens, schema) tuples keyed by an id, e.g. the post URL
+            runner (BatchRunner): Runner submitting the batches and polling them
+            temperature (float, optional): Sampling temperature
+
+        Returns:
+            dict: Responses containing generated text and metadata, keyed by the ids of the requests which succeeded
+        """
+        responses, bodies, keys = {}, {}, {}
+        provider = getattr(runner.api, 'provider', self.client_type)
+        for custom_id, (prompt, system_prompt, max_tokens, schema) in requests.items():
+            if self.cache is not None:
+                keys[custom_id] = self._cache_key(provider, prompt, system_prompt, temperature, max_tokens, schema, 0)
+                cached = self.cache.get(keys[custom_id])
+                if cached is not None:
+                    responses[custom_id] = dict(cached, cache_key=keys[custom_id])
+                    continue
+            bodies[custom_id] = {
+                'model': self.model,
+                'messages': self._openai_messages(prompt, system_prompt),
+                'temperature': temperature,
+                'max_tokens': max_tokens,
+                **self._openai_options(schema)
+            }
+        logger.info(f"Generating {len(bodies)} completions in batch with model {self.model}, "
+                    f"{len(responses)} cached")
+        for custom_id, body in (runner.run(bodies) if bodies else {}).items():
+            response = {
+                'content': body['choices'][0]['message']['content'],
+                'tokens_used': body.get('usage', {}).get('total_tokens')
+            }
+            if self.cache is not None:
+                self.cache.put(keys[custom_id], self.model, response)
+                response['cache_key'] = keys[custom_id]
+            responses[custom_id] = response
+        return responses
+
+    def discard_completion(self, response: dict):
+        """Drops a completion from the cache once its output turned out to be invalid, so it is requested again
+        instead of being replayed by the next runs
 
+        Args:
+            response (dict): A response returned by generate_completion, agenerate_completion or generate_batch
+        """
+        if self.cache is not None and response.get('cache_key'):
+            self.cache.delete(response['cache_key'])
 
+    async def aclose(self):
+        """Close the asyncio connection pool of the running event loop"""
+        client = self._async_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.close() if isinstance(client, AsyncOpenAI) else await client.aclose()
@@ -0,0 +1,97 @@
+import logging
+import os
+from typing import List, Optional, Tuple
+from jinja2 import DictLoader, Environment, FileSystemBytecodeCache
+
+logger = logging.getLogger(__name__)
+
+# Category of the posts which fit none of the configured ones, it is always one of the categories of the schema
+FALLBACK_CATEGORY = 'uncategorized'
+# Used for the map step of long posts when the configuration has no chunk_prompt
+DEFAULT_CHUNK_PROMPT = ("This is part {{ index }} of {{ total }} of the article \"{{ post.title }}\". "
+                        "Summarize its key points in a few sentences of plain text.\n\n<CONTENT>{{ chunk }}</CONTENT>")
+# Used when several posts are summarized by a single request and the configuration has no group_prompt
+DEFAULT_GROUP_PROMPT = (
+    "Write a concise and engaging summary of each of the following articles in 2-3 lines, highlighting one or two "
+    "intriguing insights. Categorize each article into one of these PREDEFINED CATEGORIES: {{ categories|join(', ') }}. "
+    "If an article does not fit into one of them, use '{{ fallback_category }}'. Respond only with a valid JSON object holding the list of "
+    "summaries, one per article, with the url of the article exactly as given: "
+    "{\"summaries\": [{\"url\": \"...\", \"summary\": \"...\", \"category\": \"...\"}]}. "
+    "No Markdown or special characters.\n\n"
+    "{% for post in posts %}<ARTICLE url=\"{{ post.url }}\">{{ post.md }}</ARTICLE>\n\n{% endfor %}")
+
+
+class PromptRenderer:
+    """
+    Renders the prompts of the summarize step. The templates of the configuration are compiled once per run
+    in a shared Jinja Environment, and the compiled code is kept in a bytecode cache between runs.
+    The system prompt does not depend on the post, it is rendered once.
+    """
+    def __init__(self, configuration: dict, cache_dir: Optional[str] = None):
+        self.categories = list(configuration.get('categories', []))
+        if self.categories and FALLBACK_CATEGORY not in {category.lower() for category in self.categories}:
+            self.categories.append(FALLBACK_CATEGORY)
+        # Lower-cased once, for the validation of the categories returned by the model
+        self.category_names = {category.lower() for category in self.categories}
+        bytecode_cache = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        # Loaded templates are cached by the environment, the bytecode cache is checked against their source
+        self.environment = Environment(loader=DictLoader({
+            'user_prompt': configuration.get('user_prompt', ''),
+            'system_prompt': configuration.get('system_prompt', ''),
+            'chunk_prompt': configuration.get('chunk_prompt', DEFAULT_CHUNK_PROMPT),
+            'group_prompt': configuration.get('group_prompt', DEFAULT_GROUP_PROMPT),
+        }), bytecode_cache=bytecode_cache, auto_reload=False)
+        prompt_globals = {'categories': self.categories, 'fallback_category': FALLBACK_CATEGORY}
+        self.user_template = self.environment.get_template('user_prompt', globals=prompt_globals)
+        self.chunk_template = self.environment.get_template('chunk_prompt')
+        self.group_template = self.environment.get_template('group_prompt', globals=prompt_globals)
+        self.system_prompt = self.environment.get_template('system_prompt').render()
+        # JSON schemas of the answers, for the structured output modes of the providers
+        category = {'type': 'string', 'enum': self.categories} if self.categories else {'type': 'string'}
+        self.summary_schema = {
+            'type': 'object',
+            'properties': {
+                'summary': {'type': 'string'},
+                'category': category,
+                'error': {'type': ['string', 'null']},
+            },
+            'required': ['summary', 'category', 'error'],
+            'additionalProperties': False,
+        }
+        self.group_schema = {
+            'type': 'object',
+            'properties': {
+                'summaries': {
+                    'type': 'array',
+                    'items': {
+                        'type': 'object',
+                        'properties': {'url': {'type': 'string'}, 'summary': {'type': 'string'}, 'category': category},
+                        'required': ['url', 'summary', 'category'],
+                        'additionalProperties': False,
+                    },
+                },
+            },
+            'required': ['summaries'],
+            'additionalProperties': False,
+        }
+
+    def render(self, post: dict) -> Tuple[str, str]:
+        """
+        Returns the user and system prompts of a post
+        """
+        return self.user_template.render(post=post), self.system_prompt
+
+    def render_chunk(self, post: dict, chunk: str, index: int, total: int) -> Tuple[str, str]:
+        """
+        Returns the user and system prompts summarizing a chunk of a long post
+        """
+        return self.chunk_template.render(post=post, chunk=chunk, index=index, total=total), self.system_prompt
+
+    def render_group(self, posts: List[dict]) -> Tuple[str, str]:
+        """
+        Returns the user and system prompts summarizing several posts at once
+        """
+        return self.group_template.render(posts=posts), self.system_prompt
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import namedtuple
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# tokens: the number of tokens debited for the request, wait: seconds to wait before sending it
+Reservation = namedtuple('Reservation', ['tokens', 'wait'])
+
+DEFAULT_LIMITS = {'requests_per_minute': 500, 'tokens_per_minute': 10000}
+
+
+class RateLimiter:
+    """
+    Thread-safe limiter of requests per minute and tokens per minute, shared by all the workers of a client.
+    A request reserves its estimated tokens *before* it is sent, so concurrent workers never overshoot the limits,
+    and the reservation is reconciled with the usage reported by the provider afterwards.
+    Both budgets refill continuously; reservations may drive them negative, which makes the next callers wait longer.
+    """
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._lock = threading.Lock()
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    @classmethod
+    def for_model(cls, model: str, rate_limits: Optional[dict]) -> 'RateLimiter':
+        """
+        Creates the limiter of a model from the rate_limits configuration: {"<model>": {...}, "default": {...}}
+        """
+        rate_limits = rate_limits or dict()
+        limits = {**DEFAULT_LIMITS, **rate_limits.get('default', {}), **rate_limits.get(model, {})}
+        logger.debug(f"Rate limits of {model}: {limits}")
+        return cls(limits['requests_per_minute'], limits['tokens_per_minute'])
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def reserve(self, tokens: int) -> Reservation:
+        """
+        Debits one request and the estimated tokens and returns how long the caller has to wait before sending
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # a request larger than the whole budget waits for a full bucket, it cannot get more
+            needed = min(tokens, self.tokens_per_minute)
+            wait = max(0.0,
+                       (1 - self._requests) * 60 / self.requests_per_minute,
+                       (needed - self._tokens) * 60 / self.tokens_per_minute,
+                       self._paused_until - now)
+            self._requests -= 1
+            self._tokens -= tokens
+        if wait > 0:
+            logger.info(f"Rate limit reached. Waiting {wait:.2f} seconds")
+        return Reservation(tokens, wait)
+
+    def acquire(self, tokens: int) -> Reservation:
+        reservation = self.reserve(tokens)
+        if reservation.wait > 0:
+            time.sleep(reservation.wait)
+        return reservation
+
+    async def aacquire(self, tokens: int) -> Reservation:
+        reservation = self.reserve(tokens)
+        if reservation.wait > 0:
+            await asyncio.sleep(reservation.wait)
+        return reservation
+
+    def reconcile(self, reservation: Reservation, tokens_used: Optional[int]):
+        """
+        Corrects the reserved tokens with the actual usage, the difference is refunded or debited
+        """
+        if tokens_used is None:
+            return
+        with self._lock:
+            self._tokens = min(self.tokens_per_minute, self._tokens + reservation.tokens - tokens_used)
+
+    def pause(self, seconds: float):
+        """
+        Holds every request for the given time, e.g. when the provider answers 429 with Retry-After
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        logger.warning(f"Provider rate limit hit, pausing requests for {seconds:.2f} seconds")
+
@@ -0,0 +1,127 @@
+import logging
+from typing import Any, Optional
+from bs4 import BeautifulSoup
+
+try:
+    from selectolax.parser import HTMLParser
+except ImportError:
+    HTMLParser = None
+
+try:
+    import lxml.html
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    CSSSelector = None
+
+logger = logging.getLogger(__name__)
+
+# The nodes of a Substack post page which are used by the scraper
+PAYWALL_SELECTOR = "h2.paywall-title"
+CONTENT_SELECTOR = "div.available-content"
+BLOG_TITLE_SELECTOR = "a.navbar-title-link"
+TITLE_SELECTOR = "h1.post-title, h2"  # When a video is present, the title is demoted to h2
+SUBTITLE_SELECTOR = "h3.subtitle"
+DATE_SELECTOR = ".pencraft.pc-reset._color-pub-secondary-text_3axfk_207._line-height-20_3axfk_95._font-meta_3axfk_131._size-11_3axfk_35._weight-medium_3axfk_162._transform-uppercase_3axfk_242._reset_3axfk_1._meta_3axfk_442"
+LIKE_COUNT_SELECTOR = "a.post-ufi-button .label"
+SELECTORS = [PAYWALL_SELECTOR, CONTENT_SELECTOR, BLOG_TITLE_SELECTOR, TITLE_SELECTOR, SUBTITLE_SELECTOR,
+             DATE_SELECTOR, LIKE_COUNT_SELECTOR]
+
+
+class SoupParser:
+    """
+    Pure-Python fallback based on BeautifulSoup and html.parser
+    """
+    name = 'html.parser'
+
+    def parse(self, html: str | bytes) -> Any:
+        return BeautifulSoup(html, "html.parser")
+
+    def exists(self, document: Any, selector: str) -> bool:
+        return document.select_one(selector) is not None
+
+    def text(self, document: Any, selector: str) -> Optional[str]:
+        element = document.select_one(selector)
+        return element.text.strip() if element else None
+
+    def html(self, document: Any, selector: str) -> Optional[str]:
+        element = document.select_one(selector)
+        return str(element) if element else None
+
+
+class SelectolaxParser:
+    """
+    Fast path based on the lexbor engine of selectolax, nodes are only materialized when selected
+    """
+    name = 'selectolax'
+
+    def parse(self, html: str | bytes) -> Any:
+        return HTMLParser(html)
+
+    def exists(self, document: Any, selector: str) -> bool:
+        return document.css_first(selector) is not None
+
+    def text(self, document: Any, selector: str) -> Optional[str]:
+        node = document.css_first(selector)
+        return node.text(deep=True).strip() if node else None
+
+    def html(self, document: Any, selector: str) -> Optional[str]:
+        node = document.css_first(selector)
+        return node.html if node else None
+
+
+class LxmlParser:
+    """
+    Fast path based on lxml with the CSS selectors compiled to XPath once
+    """
+    name = 'lxml'
+
+    def __init__(self):
+        self._selectors = {selector: CSSSelector(selector) for selector in SELECTORS}
+
+    def _first(self, document: Any, selector: str) -> Any:
+        compiled = self._selectors.get(selector)
+        if compiled is None:
+            compiled = self._selectors[selector] = CSSSelector(selector)
+        elements = compiled(document)
+        return elements[0] if elements else None
+
+    def parse(self, html: str | bytes) -> Any:
+        return lxml.html.document_fromstring(html)
+
+    def exists(self, document: Any, selector: str) -> bool:
+        return self._first(document, selector) is not None
+
+    def text(self, document: Any, selector: str) -> Optional[str]:
+        element = self._first(document, selector)
+        return element.text_content().strip() if element is not None else None
+
+    def html(self, document: Any, selector: str) -> Optional[str]:
+        element = self._first(document, selector)
+        return lxml.html.tostring(element, encoding='unicode', with_tail=False) if element is not None else None
+
+
+PARSERS = {
+    SelectolaxParser.name: (SelectolaxParser, lambda: HTMLParser is not None),
+    LxmlParser.name: (LxmlParser, lambda: CSSSelector is not None),
+    SoupParser.name: (SoupParser, lambda: True),
+}
+
+
+def available_parsers() -> list[str]:
+    return [name for name, (_, available) in PARSERS.items() if available()]
+
+
+def get_parser(name: str = 'auto'):
+    """
+    Returns the requested HTML parser backend, 'auto' picks the fastest one installed.
+    Falls back to BeautifulSoup if the requested backend is not installed.
+    """
+    if name in (None, 'auto'):
+        name = available_parsers()[0]
+    elif name not in PARSERS:
+        raise ValueError(f"Unsupported HTML parser: {name}. Choose one of {list(PARSERS)} or 'auto'")
+    elif not PARSERS[name][1]():
+        logger.warning(f'HTML parser {name} is not installed, falling back to {SoupParser.name}')
+        name = SoupParser.name
+    logger.debug(f'Using the {name} HTML parser')
+    return PARSERS[name][0]()
@@ -0,0 +1,90 @@
+import json
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from selenium import webdriver
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36'
+
+
+class CookieSession:
+    """
+    A pooled keep-alive HTTP session carrying the login cookies harvested from the authenticated browser.
+    The cookies are cached in `cookie_file` and reused across runs until they expire, so most runs
+    can fetch paywalled posts without starting the browser at all.
+    """
+    def __init__(self, cookie_file: str, pool_size: int = 10, max_age: int = 7 * 24 * 3600, timeout: int = 30):
+        """
+        Args:
+            cookie_file (str): Path of the on-disk cookie cache
+            pool_size (int): Number of keep-alive connections kept per host
+            max_age (int): Lifetime in seconds of the cookies which do not carry their own expiry
+            timeout (int): Timeout of the HTTP requests in seconds
+        """
+        self.cookie_file = cookie_file
+        self.max_age = max_age
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'User-Agent': USER_AGENT})
+        self.authenticated = self.load_cookies()
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.session.get(url, timeout=kwargs.pop('timeout', self.timeout), **kwargs)
+
+    def load_cookies(self) -> bool:
+        """
+        Loads the unexpired cookies of a previous run into the session. Returns True if any was loaded.
+        """
+        if not os.path.exists(self.cookie_file):
+            return False
+        try:
+            with open(self.cookie_file, 'r') as f:
+                cookies = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logger.warning(f'Ignoring unreadable cookie cache {self.cookie_file}: {e}')
+            return False
+        now = time.time()
+        valid = [c for c in cookies if c.get('expires') is None or c['expires'] > now]
+        for cookie in valid:
+            self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain', ''),
+                                     path=cookie.get('path', '/'), secure=cookie.get('secure', False),
+                                     expires=cookie.get('expires'))
+        logger.info(f'Loaded {len(valid)} cached cookies, {len(cookies) - len(valid)} expired')
+        return len(valid) > 0
+
+    def import_browser_cookies(self, driver: webdriver.Chrome):
+        """
+        Copies the cookies visible on the current page of the browser into the session and the on-disk cache
+        """
+        default_expiry = int(time.time()) + self.max_age
+        with self._lock:
+            for cookie in driver.get_cookies():
+                self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain', ''),
+                                         path=cookie.get('path', '/'), secure=cookie.get('secure', False),
+                                         expires=cookie.get('expiry', default_expiry))
+            self.authenticated = True
+            self.save_cookies()
+
+    def save_cookies(self):
+        cookies = [{
+            'name': c.name,
+            'value': c.value,
+            'domain': c.domain,
+            'path': c.path,
+            'secure': c.secure,
+            'expires': c.expires
+        } for c in self.session.cookies]
+        # the cookies are credentials, keep them private to the user
+        fd = os.open(self.cookie_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cookies, f, indent=2)
+        logger.debug(f'Saved {len(cookies)} cookies to {self.cookie_file}')
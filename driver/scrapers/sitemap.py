@@ -0,0 +1,101 @@
+import logging
+from datetime import datetime, timezone
+from typing import Callable, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+from xml.etree import ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+SITEMAP_NS = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+MAX_INDEX_DEPTH = 3
+# Posts in a row not newer than the high-water mark after which a newest first sitemap is not read further
+STOP_AFTER_OLD_POSTS = 10
+
+
+def parse_lastmod(text: Optional[str]) -> Optional[datetime]:
+    """
+    Parses a sitemap lastmod value into a naive UTC datetime
+    """
+    if not text:
+        return None
+    lastmod = datetime.fromisoformat(text.strip().rstrip('Z'))
+    if lastmod.tzinfo is not None:
+        lastmod = lastmod.astimezone(timezone.utc).replace(tzinfo=None)
+    return lastmod
+
+
+def is_post_url(url: str) -> bool:
+    """
+    Tells the post entries of a Substack sitemap apart from the other pages (about, archive, podcast...)
+    """
+    return '/p/' in urlparse(url).path
+
+
+def iter_sitemap(path: str, fetch: Callable[[str], Optional[str]],
+                 high_water_mark: Optional[datetime] = None) -> Iterator[Tuple[str, Optional[datetime]]]:
+    """
+    Streams the (url, lastmod) entries of a sitemap file, releasing every element once it was read.
+    Sitemap index files are followed through `fetch`, which returns the local path of a child sitemap (or None).
+    The entries not newer than the high-water mark are skipped. A sitemap file is read to its end, unless its posts
+    are listed newest first: then it stops after a run of STOP_AFTER_OLD_POSTS posts not newer than the mark.
+    Stop consuming the iterator to stop parsing early.
+
+    Args:
+        path (str): Path of the downloaded sitemap
+        fetch (Callable[[str], Optional[str]]): Downloads a child sitemap and returns its path
+        high_water_mark (datetime, optional): lastmod of the newest entry crawled before
+    """
+    yield from _iter_sitemap(path, fetch, high_water_mark, depth=0)
+
+
+def _iter_sitemap(path: str, fetch: Callable[[str], Optional[str]], high_water_mark: Optional[datetime],
+                  depth: int) -> Iterator[Tuple[str, Optional[datetime]]]:
+    root = None
+    # lastmod of the previous post of the file, and whether its posts were newest first so far
+    previous, newest_first = None, True
+    old_posts = 0
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            continue
+        if elem.tag == f'{SITEMAP_NS}url':
+            loc = elem.findtext(f'{SITEMAP_NS}loc')
+            lastmod_text = elem.findtext(f'{SITEMAP_NS}lastmod')
+            root.clear()
+            if not loc:
+                continue
+            loc = loc.strip()
+            try:
+                lastmod = parse_lastmod(lastmod_text)
+            except ValueError:
+                logger.warning(f"Invalid date format for {loc}: {lastmod_text}")
+                lastmod = None
+            post = is_post_url(loc)
+            if post and lastmod is not None:
+                if previous is not None and lastmod > previous:
+                    newest_first = False
+                previous = lastmod
+            if high_water_mark is None or lastmod is None or lastmod > high_water_mark:
+                if post:
+                    old_posts = 0
+                yield loc, lastmod
+                continue
+            # Only the posts end the file, the other pages keep their old dates at any place
+            if post:
+                old_posts += 1
+                if newest_first and old_posts >= STOP_AFTER_OLD_POSTS:
+                    logger.debug(f'Reached the high-water mark {high_water_mark.isoformat()} at {loc}')
+                    return
+        elif elem.tag == f'{SITEMAP_NS}sitemap':
+            loc = elem.findtext(f'{SITEMAP_NS}loc')
+            root.clear()
+            if not loc:
+                continue
+            if depth >= MAX_INDEX_DEPTH:
+                logger.warning(f'Sitemap index nested too deep, skipping {loc}')
+                continue
+            child_path = fetch(loc.strip())
+            if child_path is None:
+                continue
+            yield from _iter_sitemap(child_path, fetch, high_water_mark, depth + 1)
@@ -1,22 +1,28 @@
 import logging
-import requests
-import random
+import threading
 import tqdm
-from threading import stack_size
-from operator import is_not, pos
-from functools import partial
-from time import sleep
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from itertools import islice
 from urllib.parse import urlparse
 from xml.etree import ElementTree as ET
-from typing import List, Optional, Tuple
-from bs4 import BeautifulSoup
+from typing import Callable, Iterator, List, Optional, Tuple
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import TimeoutException
 from datetime import datetime
-from driver.utils.dbops import save_posts_to_db, get_existing_urls_for_domain
-from driver.utils.utils import html_to_md
+from driver.utils.dbops import save_posts_to_db, filter_new_urls, get_high_water_mark, set_high_water_mark
+from driver.utils.httpcache import HttpCache
+from driver.utils.utils import html_to_md, MarkdownConverter
+from driver.scrapers.throttle import HostThrottle
+from driver.scrapers.session import CookieSession
+from driver.scrapers.sitemap import iter_sitemap
+from driver.scrapers.parsers import get_parser, PAYWALL_SELECTOR, CONTENT_SELECTOR, BLOG_TITLE_SELECTOR, TITLE_SELECTOR, \
+    SUBTITLE_SELECTOR, DATE_SELECTOR, LIKE_COUNT_SELECTOR
 
 
 # initial source: https://github.com/timf34/Substack2Markdown/blob/main/substack_scraper.py
@@ -37,22 +43,85 @@ class TqdmLoggingHandler(logging.Handler):
 logger = logging.getLogger(__name__)
 logger.addHandler(TqdmLoggingHandler())
 
-def scrape_substack(urls: List[str], project_dir: str, num_posts_to_scrape = None, authentication: dict[str, str] = dict()):
-    total = 0
-    posts_data = list()
-    def get_url_soup(url: str) -> Optional[BeautifulSoup]:
+# Number of sitemap entries checked against the database in one query
+DEDUP_BATCH_SIZE = 200
+
+def scrape_substack(urls: List[str], project_dir: str, num_posts_to_scrape = None, authentication: dict[str, str] = dict(),
+                    concurrency: dict = None, data_folder: str = None, html_parser: str = 'auto', markdown: dict = None,
+                    save_batch_size: int = 20, on_saved: Optional[Callable[[List[dict]], None]] = None):
+    """
+    Scrapes the new posts of the given publications and saves them to the database.
+    Publications are crawled in parallel by a worker pool of `concurrency['global']` threads, while
+    `concurrency['per_host']`, `concurrency['min_delay']` and `concurrency['max_delay']` keep the crawl polite per host.
+    The Substack login cookies are cached in `data_folder` (defaults to `project_dir`).
+    Pages are parsed once with the `html_parser` backend ('auto' picks the fastest one installed).
+    Post bodies are converted to Markdown in a pool of `markdown['processes']` processes (in the scraper threads if 0)
+    and cached by content hash unless `markdown['cache']` is false.
+    Scraped posts are saved every `save_batch_size` posts, so a crash only loses the last few, and every saved batch
+    is passed to `on_saved` (e.g. to summarize the posts while the crawl goes on).
+    """
+    # posts scraped since the last save, the crawl never holds more than a batch of posts in memory
+    unsaved_posts = list()
+    saved_count = 0
+    # how the posts were acquired: 'http' (plain request), 'browser' (paywall, authenticated browser) or 'paywalled' (skipped)
+    acquisition_stats = Counter()
+    stats_lock = threading.Lock()
+
+    def is_paywalled(document) -> bool:
+        return parser.exists(document, PAYWALL_SELECTOR)
+
+    def count(path: str):
+        with stats_lock:
+            acquisition_stats[path] += 1
+
+    def fetch_post_document(url: str):
         """
-        Gets soup from URL using requests
+        Fetches and parses a post exactly once: HTTP with the cached login cookies first and the authenticated browser
+        only when the paywall is detected. Returns None if the post is still behind the paywall.
         """
+        host = urlparse(url).netloc
         try:
-            page = requests.get(url, headers=None)
-            soup = BeautifulSoup(page.content, "html.parser")
-            if soup.find("h2", class_="paywall-title"):
-                logger.warning(f'Skipping premium article: {url}')
-                return None
-            return soup
+            page = http.get(url)
+            document = parser.parse(page.content)
         except Exception as e:
             raise ValueError(f'Error fetching page: {e}') from e
+        if not is_paywalled(document):
+            count('http')
+            return document
+        if host in unsubscribed_hosts:
+            count('paywalled')
+            logger.warning(f'Skipping premium article: {url}')
+            return None
+        browser = get_driver()
+        if browser is None:
+            count('paywalled')
+            logger.warning(f'Skipping premium article: {url}')
+            return None
+        logger.debug(f'Paywall detected, fetching {url} with the authenticated browser')
+        document = get_authenticated_url_document(url, driver=browser)
+        if is_paywalled(document):
+            # not even the logged in browser can read it, there is no paid subscription for this publication
+            unsubscribed_hosts.add(host)
+            count('paywalled')
+            logger.warning(f'Skipping premium article: {url}')
+            return None
+        count('browser')
+        return document
+
+    def get_driver() -> Optional[webdriver.Chrome]:
+        """
+        Starts the authenticated browser on first use, most runs do not need it at all.
+        Returns None if the login failed, it is not tried again during the run.
+        """
+        nonlocal driver, login_failed
+        with driver_lock:
+            if driver is None and not login_failed:
+                try:
+                    driver = get_authenticated_driver()
+                except Exception as e:
+                    login_failed = True
+                    logger.error(f'The browser login failed, the premium posts are skipped for the rest of the run: {e}')
+            return driver
    
     def get_authenticated_driver():
         logger.info('Authenticating with Substack')
@@ -81,116 +150,118 @@ def scrape_substack(urls: List[str], project_dir: str, num_posts_to_scrape = Non
         logger.debug(f'Initializing driver with path: {project_dir}/chromedriver/chromedriver')
         service = Service(executable_path=f'{project_dir}/chromedriver/chromedriver')
         driver = webdriver.Chrome(service=service, options=options)
+        wait_for = WebDriverWait(driver, timeout=20)
         driver.get("https://substack.com/sign-in")
-        sleep(3)
-        signin_with_password = driver.find_element(
-            By.XPATH, "//a[@class='login-option substack-login__login-option']"
-        )
+        signin_with_password = wait_for.until(EC.element_to_be_clickable(
+            (By.XPATH, "//a[@class='login-option substack-login__login-option']")
+        ))
         signin_with_password.click()
-        sleep(3)
-                # Email and password
-        email = driver.find_element(By.NAME, "email")
-        password = driver.find_element(By.NAME, "password")
+        # Email and password
+        email = wait_for.until(EC.visibility_of_element_located((By.NAME, "email")))
+        password = wait_for.until(EC.visibility_of_element_located((By.NAME, "password")))
         logger.debug(f"email: {authentication.get('email','')}")
         email.send_keys(authentication.get('email',''))
         password.send_keys(authentication.get('password',''))
 
         # Find the submit button and click it.
-        submit = driver.find_element(By.XPATH, "//*[@id=\"substack-login\"]/div[2]/div[2]/form/button")
-        sleep(3)
+        submit = wait_for.until(EC.element_to_be_clickable(
+            (By.XPATH, "//*[@id=\"substack-login\"]/div[2]/div[2]/form/button")
+        ))
         logger.debug('submitting password')
         submit.click()
-        sleep(5)  # Wait for the page to load
+        # Wait until the sign-in page is left or the error is shown
+        try:
+            wait_for.until(lambda d: 'sign-in' not in d.current_url or check_failed_login())
+        except TimeoutException:
+            pass
 
         if check_failed_login():
+            driver.quit()
             raise Exception("Warning: Login unsuccessful. Please check your email and password, or your account status.\n"
                   "Use the non-premium scraper for the non-paid posts. \n"
                   "If running headless, run non-headlessly to see if blocked by Captcha.")
+        http.import_browser_cookies(driver)
         logger.debug('returning authenticated driver')
         return driver
 
 
-    def get_authenticated_url_soup(url: str, driver: webdriver.Chrome) -> BeautifulSoup:
+    def get_authenticated_url_document(url: str, driver: webdriver.Chrome):
         """
-        Gets soup from URL using logged in selenium driver
+        Gets the parsed page from URL using logged in selenium driver and harvests the cookies of its domain,
+        so the next posts of the publication can be fetched over HTTP
         """
         try:
-            driver.get(url)
-            return BeautifulSoup(driver.page_source, "html.parser")
+            # the webdriver is not thread safe, only one worker can drive it at a time
+            with browser_lock:
+                driver.get(url)
+                page_source = driver.page_source
+                http.import_browser_cookies(driver)
+            return parser.parse(page_source)
         except Exception as e:
             raise ValueError(f"Error fetching page: {e}") from e
 
 
-    def extract_post_data(soup: BeautifulSoup) -> Tuple[str, str, str, str, str]:
+    def extract_post_data(document) -> Tuple[str, str, str, str, str, str]:
         """
-        Converts substack post soup to markdown, returns metadata and content
+        Converts the parsed substack post to markdown, returns metadata and content
         """
-        blog_title_element = soup.select_one("a.navbar-title-link")
-        blog_title = blog_title_element.text.strip() if blog_title_element else ""
-        
-        title_element = soup.select_one("h1.post-title, h2")
-        title = title_element.text.strip() if title_element else "" # When a video is present, the title is demoted to h2
-
-        subtitle_element = soup.select_one("h3.subtitle")
-        subtitle = subtitle_element.text.strip() if subtitle_element else ""
-
-        date_selector = ".pencraft.pc-reset._color-pub-secondary-text_3axfk_207._line-height-20_3axfk_95._font-meta_3axfk_131._size-11_3axfk_35._weight-medium_3axfk_162._transform-uppercase_3axfk_242._reset_3axfk_1._meta_3axfk_442"
-        date_element = soup.select_one(date_selector)
-        date = date_element.text.strip() if date_element else "Date not available"
-
-        like_count_element = soup.select_one("a.post-ufi-button .label")
-        like_count = like_count_element.text.strip() if like_count_element else "Like count not available"
-
-        content = str(soup.select_one("div.available-content"))
-        md = html_to_md(title, subtitle, date, like_count, content)
+        blog_title = parser.text(document, BLOG_TITLE_SELECTOR) or ""
+        title = parser.text(document, TITLE_SELECTOR) or ""
+        subtitle = parser.text(document, SUBTITLE_SELECTOR) or ""
+        date = parser.text(document, DATE_SELECTOR) or "Date not available"
+        like_count = parser.text(document, LIKE_COUNT_SELECTOR) or "Like count not available"
+        content = parser.html(document, CONTENT_SELECTOR) or ""
+        md = html_to_md(title, subtitle, date, like_count, content, converter=md_converter)
         return blog_title, title, subtitle, like_count, date, md
 
-    def fetch_urls_from_sitemap(url: str) -> List[Tuple[str, Optional[datetime]]]:
+    def fetch_urls_from_sitemap(url: str, high_water_mark: Optional[datetime] = None,
+                                crawled_validator: Optional[str] = None) -> Tuple[Optional[Iterator[Tuple[str, Optional[datetime]]]], Optional[str]]:
         """
-        Fetch urls and last modified dates from sitemap.xml
+        Streams urls and last modified dates from sitemap.xml, revalidating the cached copy with a conditional request.
+        The iteration stops at the high-water mark. Returns None instead of the urls if the sitemap did not change
+        since the publication was last crawled to the end (its validator is the one of that crawl), and the validator of the sitemap.
         """
-        rsp = requests.get(f'{url}sitemap.xml')
+        rsp = http_cache.fetch(http, f'{url}sitemap.xml')
         if not rsp.ok:
             logger.warning(f'Error fetching sitemap at {url}: {rsp.status_code}')
-            return list()
-        root = ET.fromstring(rsp.content)
-        urls_and_dates = []
-        for url_element in root.iter('{http://www.sitemaps.org/schemas/sitemap/0.9}url'):
-            loc = url_element.find('{http://www.sitemaps.org/schemas/sitemap/0.9}loc')
-            lastmod = url_element.find('{http://www.sitemaps.org/schemas/sitemap/0.9}lastmod')
-            if loc is not None:
-                lastmod_date = None
-                if lastmod is not None and lastmod.text:
-                    try:
-                        lastmod_date = datetime.fromisoformat(lastmod.text.rstrip('Z'))
-                    except ValueError:
-                        logger.warning(f"Invalid date format for {loc.text}: {lastmod.text}")
-                urls_and_dates.append((loc.text, lastmod_date))
-        return urls_and_dates
+            return iter(()), None
+        if rsp.not_modified and rsp.validator is not None and rsp.validator == crawled_validator:
+            return None, rsp.validator
+        return iter_sitemap(rsp.path, fetch_child_sitemap, high_water_mark), rsp.validator
+
+    def fetch_child_sitemap(url: str) -> Optional[str]:
+        """
+        Fetches a sitemap listed in a sitemap index and returns the path of its cached copy
+        """
+        with throttle.slot(urlparse(url).netloc):
+            rsp = http_cache.fetch(http, url)
+        if not rsp.ok:
+            logger.warning(f'Error fetching sitemap at {url}: {rsp.status_code}')
+            return None
+        return rsp.path
     
     def fetch_urls_from_feed(url: str) -> List[dict]: 
         """
         Fetches URLs from feed.xml.
         """ 
-        rsp = requests.get(f'{url}feed.xml')
+        rsp = http_cache.fetch(http, f'{url}feed.xml')
         if not rsp.ok:
             logger.warning(f'Error fetching feed at {url}: {rsp.status_code}')
             return list()
-        root = ET.fromstring(rsp.content)
+        root = ET.parse(rsp.path).getroot()
         return [{'link': getattr(item.find('link'), 'text', None),'date': getattr(item.find('pubDate'),'text', None)} for item in root.findall('.//channel/item') if item is not None]
      
-    def scrape_post(post_url, domain, driver):
+    def scrape_post(post_url, domain):
             try:
                 url_leaf = next((item for item in reversed(urlparse(post_url).path.split('/'))), None)
                 if url_leaf in ['about', 'archive']:
                     logger.warn(f'Skipping {post_url} as it is not a post (about or archive)')
                     return None
                 logger.info(f'Scraping {post_url}')
-                soup = get_authenticated_url_soup(post_url, driver=driver)
-                soup = get_url_soup(post_url)
-                if soup is None:
+                document = fetch_post_document(post_url)
+                if document is None:
                     return 'retry'
-                blog_title, title, subtitle, like_count, date, md = extract_post_data(soup)
+                blog_title, title, subtitle, like_count, date, md = extract_post_data(document)
                 return {
                     'domain': domain,
                     'blog_title': blog_title,
@@ -205,50 +276,161 @@ def scrape_substack(urls: List[str], project_dir: str, num_posts_to_scrape = Non
                 logger.error(e, stack_info=True, exc_info=True)
                 return None
      
-    driver = get_authenticated_driver()
-    
-    # start scraping
+    def discover_posts(url: str, domain: str) -> Tuple[List[Tuple[str, Optional[datetime]]], Optional[datetime], bool, Optional[str]]:
+        """
+        Lists the posts of a publication which are newer than its high-water mark and not yet in the database.
+        With a scraping budget the sitemap is only read until enough candidates are found (twice the budget,
+        so premium posts can be replaced).
+        Returns the posts, the newest lastmod date of the sitemap, whether the listing was cut short by the budget
+        and the validator of the sitemap.
+        """
+        high_water_mark, crawled_validator = get_high_water_mark(domain)
+        with throttle.slot(urlparse(url).netloc):
+            sitemap_urls_and_dates, validator = fetch_urls_from_sitemap(url, high_water_mark, crawled_validator)
+        if sitemap_urls_and_dates is None:
+            logger.info(f'Sitemap of {url} not modified since the last complete crawl')
+            return list(), None, False, validator
+
+        limit = 2 * num_posts_to_scrape if num_posts_to_scrape is not None else None
+        candidates, newest, truncated, entries = list(), None, False, 0
+        # The sitemap is deduplicated against the database one batch at a time
+        while not truncated:
+            batch = list(islice(sitemap_urls_and_dates, DEDUP_BATCH_SIZE))
+            if not batch:
+                break
+            entries += len(batch)
+            dates = [date for _, date in batch if date is not None] + ([newest] if newest is not None else [])
+            newest = max(dates, default=None)
+            # Filter out posts that are not articles or already in the database
+            batch = [(post_url, date) for post_url, date in batch
+                     if urlparse(post_url).path.split('/')[-1] not in ['about', 'archive', 'podcast']]
+            new_urls = filter_new_urls(domain, [post_url for post_url, _ in batch])
+            for post_url, date in batch:
+                if post_url not in new_urls:
+                    continue
+                # the same post can be listed more than once
+                new_urls.discard(post_url)
+                candidates.append((post_url, date))
+                if limit is not None and len(candidates) >= limit:
+                    truncated = True
+                    break
+        if hasattr(sitemap_urls_and_dates, 'close'):
+            # stops the parser and releases the sitemap file
+            sitemap_urls_and_dates.close()
+        logger.debug(f'Read {entries} sitemap entries for {url}{" (stopped early)" if truncated else ""}')
+        return candidates, newest, truncated, validator
+
+    def save_posts():
+        nonlocal saved_count
+        if not unsaved_posts:
+            return
+        save_posts_to_db(unsaved_posts)
+        saved_count += len(unsaved_posts)
+        if on_saved is not None:
+            on_saved(list(unsaved_posts))
+        unsaved_posts.clear()
+
+    def throttled_scrape_post(post_url, domain):
+        with throttle.slot(urlparse(post_url).netloc):
+            return scrape_post(post_url, domain)
+
+    concurrency = concurrency or dict()
+    max_workers = max(1, concurrency.get('global', 4))
+    throttle = HostThrottle(per_host=concurrency.get('per_host', 1),
+                            min_delay=concurrency.get('min_delay', 2),
+                            max_delay=concurrency.get('max_delay', 5))
+    driver_lock = threading.Lock()
+    browser_lock = threading.Lock()
+    driver = None
+    login_failed = False
+    unsubscribed_hosts = set()
+    http = CookieSession(f'{data_folder or project_dir}/substack_cookies.json', pool_size=max_workers)
+    http_cache = HttpCache(f'{data_folder or project_dir}/http_cache')
+    parser = get_parser(html_parser)
+    markdown = markdown or dict()
+    md_converter = MarkdownConverter(processes=markdown.get('processes', 0), cache=markdown.get('cache', True),
+                                     cache_max_entries=markdown.get('cache_max_entries', 2000),
+                                     cache_max_age_days=markdown.get('cache_max_age_days', 30))
+    if http.authenticated:
+        logger.info('Reusing the cached Substack login cookies')
+
+    publications = dict()
     for url in urls:
         url = url if url.endswith('/') else url + '/'
         domain = [p for p in urlparse(url).netloc.split('.') if p != 'www'][0]
-        # os.makedirs(f'{working_dir}/{domain}', exist_ok=True) 
-        
-        sitemap_urls_and_dates: List[Tuple[str, Optional[datetime]]] = fetch_urls_from_sitemap(url)
-        logger.debug(f'length of sitemaps for {url}: {len(sitemap_urls_and_dates)}')
-        
-        # Filter out posts that are already in the database
-        
-        filtered_sitemap_urls_and_dates = [
-            (url, date) for url, date in sitemap_urls_and_dates
-            if urlparse(url).path.split('/')[-1] not in ['about', 'archive', 'podcast']
-        ]
-        
+        publications[domain] = url
 
-        existing_urls = get_existing_urls_for_domain(domain)
-        filtered_sitemap_urls_and_dates = [
-            (url, date) for url, date in filtered_sitemap_urls_and_dates
-            if url not in existing_urls
-        ]
-        if len(filtered_sitemap_urls_and_dates) == 0:
-            logger.info(f'No new posts found for {url}. Skipping to next URL.')
-            continue
-
-        logger.debug(f'Filtered sitemap URLs for {url}: {len(filtered_sitemap_urls_and_dates)}')
-        total = num_posts_to_scrape if num_posts_to_scrape is not None else len(filtered_sitemap_urls_and_dates)
-        logger.info(f'Scraping {total} posts after filtering for {url}.')
-
-        for post_url, post_date in tqdm.tqdm(filtered_sitemap_urls_and_dates[:total], total=total):
-            result = scrape_post(post_url, domain, driver)
-            if result == 'retry':
-                total += 1
-            elif result:
-                result['date'] = post_date.isoformat() if post_date else None
-                posts_data.append(result)    
-            sleep(random.uniform(2, 5))
-    
-    driver.quit()
-    logger.info('Scraping is finished')
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scraper') as pool:
+        # Discover new posts of every publication in parallel
+        discovered = {domain: pool.submit(discover_posts, url, domain) for domain, url in publications.items()}
+        crawls = dict()
+        # newest sitemap lastmod and sitemap validator per publication,
+        # they become the high-water mark once every newer post is crawled
+        newest_dates = dict()
+        for domain, future in discovered.items():
+            url = publications[domain]
+            try:
+                candidates, newest, truncated, validator = future.result()
+            except Exception as e:
+                logger.error(f'Error discovering posts for {url}: {e}', exc_info=True)
+                continue
+            if not truncated:
+                newest_dates[domain] = newest, validator
+            if len(candidates) == 0:
+                logger.info(f'No new posts found for {url}. Skipping.')
+                continue
+            logger.debug(f'Filtered sitemap URLs for {url}: {len(candidates)}')
+            budget = min(num_posts_to_scrape, len(candidates)) if num_posts_to_scrape is not None else len(candidates)
+            logger.info(f'Scraping {budget} posts after filtering for {url}.')
+            crawls[domain] = {'candidates': iter(candidates), 'remaining': len(candidates), 'budget': budget,
+                              'in_flight': 0, 'failed': 0}
+        total = sum(crawl['budget'] for crawl in crawls.values())
+
+        # Crawl the posts of all publications concurrently, the throttle keeps the per-host politeness
+        pending = dict()
+        def schedule(domain):
+            crawl = crawls[domain]
+            while crawl['in_flight'] < min(throttle.per_host, crawl['budget']):
+                post_url, post_date = next(crawl['candidates'], (None, None))
+                if post_url is None:
+                    return
+                crawl['in_flight'] += 1
+                crawl['remaining'] -= 1
+                pending[pool.submit(throttled_scrape_post, post_url, domain)] = (domain, post_date)
+
+        with tqdm.tqdm(total=total) as progress:
+            for domain in crawls:
+                schedule(domain)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    domain, post_date = pending.pop(future)
+                    crawl = crawls[domain]
+                    crawl['in_flight'] -= 1
+                    result = future.result()
+                    if result != 'retry':
+                        # a premium post does not count towards the budget, the next candidate replaces it
+                        crawl['budget'] -= 1
+                        progress.update(1)
+                    if result is None:
+                        crawl['failed'] += 1
+                    elif result != 'retry':
+                        result['date'] = post_date.isoformat() if post_date else None
+                        unsaved_posts.append(result)
+                        if len(unsaved_posts) >= save_batch_size:
+                            save_posts()
+                    schedule(domain)
+            save_posts()
+
+    if driver is not None:
+        driver.quit()
+    md_converter.close()
+    logger.info(f'Scraping is finished, {saved_count} posts saved')
+    logger.info(f"Acquired {acquisition_stats['http']} posts over HTTP, {acquisition_stats['browser']} needed the browser, "
+                f"{acquisition_stats['paywalled']} were skipped behind the paywall")
 
-    # Save the scraped posts to the database
-    save_posts_to_db(posts_data)
-    # print(json.dumps(posts_data, ensure_ascii=False, indent=4))
\ No newline at end of file
+    # Advance the high-water mark of the publications whose new posts were all listed and crawled
+    for domain, (newest, validator) in newest_dates.items():
+        crawl = crawls.get(domain)
+        if (newest is not None or validator is not None) and (crawl is None or (crawl['remaining'] == 0 and crawl['failed'] == 0)):
+            set_high_water_mark(domain, newest, validator)
@@ -0,0 +1,44 @@
+import logging
+import random
+import threading
+from contextlib import contextmanager
+from time import monotonic, sleep
+
+logger = logging.getLogger(__name__)
+
+
+class HostThrottle:
+    """
+    Enforces politeness per host: at most `per_host` requests in flight against the same host
+    and a random delay between `min_delay` and `max_delay` seconds between two consecutive requests to it.
+    Requests against different hosts do not wait for each other.
+    """
+    def __init__(self, per_host: int = 1, min_delay: float = 2.0, max_delay: float = 5.0):
+        self.per_host = max(1, per_host)
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self._lock = threading.Lock()
+        self._semaphores: dict[str, threading.Semaphore] = {}
+        self._next_slot: dict[str, float] = {}
+
+    def _semaphore(self, host: str) -> threading.Semaphore:
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
+
+    @contextmanager
+    def slot(self, host: str):
+        """
+        Blocks until a request against the host is allowed, then holds one of its concurrency slots
+        """
+        with self._semaphore(host):
+            with self._lock:
+                now = monotonic()
+                start = max(now, self._next_slot.get(host, now))
+                self._next_slot[host] = start + random.uniform(self.min_delay, self.max_delay)
+            wait = start - now
+            if wait > 0:
+                logger.debug(f'Waiting {wait:.2f}s before next request to {host}')
+                sleep(wait)
+            yield
@@ -1,24 +1,324 @@
 import logging
 import sqlite3
 import atexit
-from datetime import datetime
+import threading
+import zlib
+from datetime import datetime, timedelta
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
 # Global connection object
 conn = None
+# The connection is shared by the worker threads, the lock serializes its use
+db_lock = threading.RLock()
+# Maximum number of URLs bound to a single IN (...) lookup, old SQLite builds allow 999 variables per statement
+URL_LOOKUP_BATCH_SIZE = 500
+# Number of rows written per transaction by the bulk save operations
+WRITE_BATCH_SIZE = 500
+# Compression of the post bodies written by this process: None, 'zlib' or 'zstd' (set by initialize_db)
+body_compression = None
 
-def initialize_db(database_file):
-    global conn
-    conn = sqlite3.connect(database_file)
+PRAGMAS = {
+    'journal_mode': 'WAL',  # readers do not block the writer and commits append to the log instead of rewriting pages
+    'synchronous': 'NORMAL',  # durable across application crashes, fsync only at checkpoints in WAL mode
+    'temp_store': 'MEMORY',
+    'cache_size': -32000,  # 32 MiB page cache
+    'busy_timeout': 5000,
+}
+
+# Version 1 of the schema, the layout of the databases created before the migrations were versioned
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        domain TEXT,
+        blog_title TEXT,
+        url TEXT UNIQUE,
+        title TEXT,
+        subtitle TEXT,
+        like_count INTEGER,
+        date TEXT,
+        md TEXT,
+        source TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        processed BOOLEAN DEFAULT FALSE
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_posts_domain_url ON posts (domain, url)",
+    # Covers the ranking of the unprocessed posts (the rowid is part of every index entry),
+    # only the unprocessed rows are indexed so it stays small as the archive grows
+    "CREATE INDEX IF NOT EXISTS idx_posts_unprocessed ON posts (domain, date) WHERE processed = 0",
+    '''
+    CREATE TABLE IF NOT EXISTS summaries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        url TEXT UNIQUE,
+        title TEXT,
+        subtitle TEXT,
+        domain TEXT,
+        date TEXT,
+        summary TEXT,
+        category TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS crawl_state (
+        domain TEXT PRIMARY KEY,
+        high_water_mark TEXT,
+        updated_at TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS md_cache (
+        content_hash TEXT PRIMARY KEY,
+        md TEXT,
+        created_at TEXT
+    )
+    ''',
+]
+
+
+def encode_body(md):
+    """
+    Encode a post body for the post_bodies table with the configured compression.
+
+    Args:
+        md (str): The Markdown body of the post.
+
+    Returns:
+        tuple: The encoding ('text', 'zlib' or 'zstd') and the stored body.
+    """
+    if md is None or not body_compression:
+        return 'text', md
+    if body_compression == 'zstd' and zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=9).compress(md.encode('utf-8'))
+    return 'zlib', zlib.compress(md.encode('utf-8'), 6)
+
+
+def decode_body(encoding, body):
+    """
+    Decode a post body stored by encode_body.
+
+    Args:
+        encoding (str): The encoding of the body, None when the post has no body.
+        body: The stored body.
+
+    Returns:
+        str: The Markdown body of the post.
+    """
+    if encoding is None or body is None or encoding == 'text':
+        return body
+    if encoding == 'zlib':
+        return zlib.decompress(body).decode('utf-8')
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("The post body is zstd-compressed, install the zstandard package to read it.")
+        return zstandard.ZstdDecompressor().decompress(body).decode('utf-8')
+    raise ValueError(f"Unknown post body encoding: {encoding}")
+
+
+def move_post_bodies(cursor):
+    """
+    Migration to version 2: the Markdown bodies are moved from the posts table to the post_bodies table,
+    so the scans of the post metadata do not read them, and they are compressed with the configured compression.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS post_bodies (
+            post_id INTEGER PRIMARY KEY REFERENCES posts (id),
+            encoding TEXT NOT NULL,
+            body BLOB
+        )
+    ''')
+    last_id, moved = 0, 0
+    while True:
+        cursor.execute("SELECT id, md FROM posts WHERE id > ? AND md IS NOT NULL ORDER BY id LIMIT ?",
+                       (last_id, WRITE_BATCH_SIZE))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        cursor.executemany("INSERT OR REPLACE INTO post_bodies (post_id, encoding, body) VALUES (?, ?, ?)",
+                           [(post_id, *encode_body(md)) for post_id, md in rows])
+        last_id = rows[-1][0]
+        moved += len(rows)
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        cursor.execute("ALTER TABLE posts DROP COLUMN md")
+    else:
+        # DROP COLUMN is not available, the column is left empty
+        cursor.execute("UPDATE posts SET md = NULL")
+    logger.info(f"Moved {moved} post bodies to the post_bodies table.")
+
+
+# Two full-text indexes: posts_fts holds the titles and bodies of the posts, summaries_fts the summaries, they are
+# joined at query time. posts_fts reads its text from the post_search view (its external content), which decodes the
+# bodies with the decode_body function registered by initialize_db. It is written by save_posts_to_db with the text
+# at hand, no trigger decodes a body on the write path. A post changed by another tool (the sqlite3 shell, a script)
+# is indexed again with the 'rebuild' command of posts_fts. summaries_fts indexes the summaries table, its triggers
+# only read the summary.
+SEARCH_SCHEMA = [
+    '''
+    CREATE VIEW IF NOT EXISTS post_search AS
+    SELECT posts.id AS id, posts.title AS title, posts.subtitle AS subtitle,
+           decode_body(post_bodies.encoding, post_bodies.body) AS body
+    FROM posts
+    LEFT JOIN post_bodies ON post_bodies.post_id = posts.id
+    ''',
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5 (
+        title, subtitle, body,
+        content = 'post_search', content_rowid = 'id', tokenize = 'porter unicode61'
+    )
+    ''',
+    '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS summaries_fts USING fts5 (
+        summary,
+        content = 'summaries', content_rowid = 'id', tokenize = 'porter unicode61'
+    )
+    ''',
+    # The matches in the titles and summaries rank higher than the ones in the bodies
+    "INSERT INTO posts_fts (posts_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 1.0)')",
+    "INSERT INTO summaries_fts (summaries_fts, rank) VALUES ('rank', 'bm25(3.0)')",
+    '''
+    CREATE TRIGGER IF NOT EXISTS summaries_fts_insert AFTER INSERT ON summaries BEGIN
+        INSERT INTO summaries_fts (rowid, summary) VALUES (NEW.id, NEW.summary);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS summaries_fts_update AFTER UPDATE OF summary ON summaries BEGIN
+        INSERT INTO summaries_fts (summaries_fts, rowid, summary) VALUES ('delete', OLD.id, OLD.summary);
+        INSERT INTO summaries_fts (rowid, summary) VALUES (NEW.id, NEW.summary);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS summaries_fts_delete AFTER DELETE ON summaries BEGIN
+        INSERT INTO summaries_fts (summaries_fts, rowid, summary) VALUES ('delete', OLD.id, OLD.summary);
+    END
+    ''',
+    # Indexes the posts and summaries saved before
+    "INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')",
+    "INSERT INTO summaries_fts (summaries_fts) VALUES ('rebuild')",
+]
+
+
+def split_search_index(cursor):
+    """
+    Migration to version 8: the single index of version 4, kept in sync by triggers which decoded the body of
+    the post on every change of a post, body or summary, is replaced by the posts and summaries indexes.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'posts_fts_insert'")
+    if cursor.fetchone() is None:
+        # Created at version 4 with the current schema
+        return
+    for trigger in ('posts_fts_insert', 'posts_fts_before_update', 'posts_fts_after_update', 'posts_fts_delete',
+                    'post_bodies_fts_insert', 'post_bodies_fts_before_update', 'post_bodies_fts_after_update',
+                    'summaries_fts_insert', 'summaries_fts_before_update', 'summaries_fts_after_update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("DROP TABLE IF EXISTS posts_fts")
+    cursor.execute("DROP VIEW IF EXISTS post_search")
+    for statement in SEARCH_SCHEMA:
+        cursor.execute(statement)
+    logger.info("Split the full-text index of the posts and the summaries.")
+
+
+# The migration at index i upgrades the schema to version i + 1, it is either a list of
+# statements or a function taking a cursor. The version is stored in PRAGMA user_version.
+MIGRATIONS = [
+    SCHEMA,
+    move_post_bodies,
+    # Version 3: the summarization state of the posts, processed stays set for the done posts only
+    [
+        "ALTER TABLE posts ADD COLUMN state TEXT NOT NULL DEFAULT 'pending'",
+        "ALTER TABLE posts ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE posts ADD COLUMN lease_owner TEXT",
+        "ALTER TABLE posts ADD COLUMN lease_expires_at TEXT",
+        "UPDATE posts SET state = 'done' WHERE processed",
+    ],
+    # Version 4: full-text index of the posts and their summaries
+    SEARCH_SCHEMA,
+    # Version 5: the summaries published in the digests
+    [
+        "CREATE INDEX IF NOT EXISTS idx_summaries_created_at ON summaries (created_at)",
+        '''
+        CREATE TABLE IF NOT EXISTS digest_state (
+            digest TEXT PRIMARY KEY,
+            last_summary_id INTEGER,
+            updated_at TEXT
+        )
+        ''',
+    ],
+    # Version 6: the sitemap version of the last complete crawl, a 304 only skips the publications crawled to the end
+    [
+        "ALTER TABLE crawl_state ADD COLUMN sitemap_validator TEXT",
+    ],
+    # Version 7: the Markdown cache is evicted from the oldest entries
+    [
+        "CREATE INDEX IF NOT EXISTS idx_md_cache_created_at ON md_cache (created_at)",
+    ],
+    split_search_index,
+]
+
+
+def migrate():
+    """
+    Apply the migrations which are newer than the version of the database, each one in its own transaction.
+
+    Returns:
+        int: The number of migrations applied.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    pending = MIGRATIONS[version:]
+    # The databases created before the versioning are at version 0 too
+    existing = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'posts'").fetchone()
+    for number, migration in enumerate(pending, start=version + 1):
+        # An explicit transaction, the DDL statements do not start one implicitly
+        conn.execute("BEGIN")
+        with conn:
+            cursor = conn.cursor()
+            if callable(migration):
+                migration(cursor)
+            else:
+                for statement in migration:
+                    cursor.execute(statement)
+            cursor.execute(f"PRAGMA user_version = {number}")
+        logger.info(f"Migrated the database to version {number}.")
+    if pending and existing:
+        # Return the pages freed by the migrations to the file system
+        conn.execute("VACUUM")
+    return len(pending)
+
+
+def initialize_db(database_file, compression=None):
+    """
+    Open the database, tune the connection and migrate the schema to the latest version.
+
+    Args:
+        database_file (str): The path of the SQLite database.
+        compression (str): The compression of the post bodies written: None, 'zlib' or 'zstd'.
+    """
+    global conn, body_compression
+    if compression == 'zstd' and zstandard is None:
+        logger.warning("The zstandard package is not installed, the post bodies are compressed with zlib.")
+    body_compression = compression
+    conn = sqlite3.connect(database_file, check_same_thread=False)
     conn.row_factory = sqlite3.Row  # This enables column access by name
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    # Used by the full-text index, see SEARCH_SCHEMA
+    conn.create_function('decode_body', 2, decode_body, deterministic=True)
+    migrate()
     atexit.register(close_db)
 
 def close_db():
     global conn
-    if conn:
-        conn.close()
-        conn = None
+    with db_lock:
+        if conn:
+            conn.close()
+            conn = None
 
 def get_cursor():
     global conn
@@ -29,34 +329,192 @@ def get_cursor():
 def get_existing_urls_for_domain(domain):
     """
     Retrieve all URLs for a given domain from the SQLite database.
-    If the posts table doesn't exist, return an empty list.
 
     Args:
         domain (str): The domain to fetch URLs for.
 
     Returns:
-        list: A list of URLs associated with the given domain.
+        set: The URLs associated with the given domain.
     """
     cursor = get_cursor()
 
     try:
-        # Check if the posts table exists
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='posts'")
-        if cursor.fetchone() is None:
-            logger.debug("Posts table does not exist yet. Returning empty url list for {domain}.")
-            return []
-
-        cursor.execute("SELECT url FROM posts WHERE domain = ?", (domain,))
-        urls = [row[0] for row in cursor.fetchall()]
+        with db_lock:
+            cursor.execute("SELECT url FROM posts WHERE domain = ?", (domain,))
+            urls = {row[0] for row in cursor.fetchall()}
         return urls
     except sqlite3.Error as e:
         logger.error(f"Database error: {e}")
-        return []
-    
+        return set()
+
+
+def filter_new_urls(domain, urls):
+    """
+    Find which of the given URLs of a domain are not yet in the database.
+    The lookup is an anti-join of batched IN (...) queries served by the (domain, url) index.
+
+    Args:
+        domain (str): The domain the URLs belong to.
+        urls (iterable): The URLs to check.
+
+    Returns:
+        set: The URLs which are not yet stored.
+    """
+    cursor = get_cursor()
+    urls = list(dict.fromkeys(urls))
+
+    try:
+        existing_urls = set()
+        with db_lock:
+            for i in range(0, len(urls), URL_LOOKUP_BATCH_SIZE):
+                batch = urls[i:i + URL_LOOKUP_BATCH_SIZE]
+                cursor.execute(
+                    "SELECT url FROM posts WHERE domain = ? AND url IN ({})".format(','.join(['?'] * len(batch))),
+                    (domain, *batch))
+                existing_urls.update(row[0] for row in cursor.fetchall())
+        return set(urls) - existing_urls
+    except sqlite3.Error as e:
+        logger.error(f"Database error when filtering new URLs: {e}")
+        return set(urls)
+
+
+def get_high_water_mark(domain):
+    """
+    Retrieve the newest sitemap lastmod date which was fully crawled for the given domain,
+    and the validator (ETag or Last-Modified) of the sitemap at the end of that crawl.
+
+    Args:
+        domain (str): The domain to fetch the high-water mark for.
+
+    Returns:
+        tuple: The high-water mark (datetime) and the sitemap validator (str), None for the ones never stored.
+    """
+    cursor = get_cursor()
+
+    try:
+        with db_lock:
+            cursor.execute("SELECT high_water_mark, sitemap_validator FROM crawl_state WHERE domain = ?", (domain,))
+            row = cursor.fetchone()
+        if row is None:
+            return None, None
+        return datetime.fromisoformat(row[0]) if row[0] else None, row[1]
+    except sqlite3.Error as e:
+        logger.error(f"Database error when fetching high-water mark: {e}")
+        return None, None
+
+
+def set_high_water_mark(domain, high_water_mark, sitemap_validator=None):
+    """
+    Store the newest sitemap lastmod date which was fully crawled for the given domain,
+    with the validator of the sitemap which was crawled to the end.
+
+    Args:
+        domain (str): The domain to store the high-water mark for.
+        high_water_mark (datetime): The newest lastmod date of the crawled sitemap entries, the stored one is kept when None.
+        sitemap_validator (str, optional): The ETag or Last-Modified date of the crawled sitemap.
+    """
+    cursor = get_cursor()
+
+    try:
+        with db_lock, conn:
+            cursor.execute("""
+                INSERT INTO crawl_state (domain, high_water_mark, sitemap_validator, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(domain) DO UPDATE SET
+                    high_water_mark = COALESCE(excluded.high_water_mark, crawl_state.high_water_mark),
+                    sitemap_validator = excluded.sitemap_validator,
+                    updated_at = excluded.updated_at
+            """, (domain, high_water_mark.isoformat() if high_water_mark else None, sitemap_validator,
+                  datetime.now().isoformat()))
+        logger.debug(f"High-water mark of {domain} set to {high_water_mark.isoformat() if high_water_mark else None} "
+                     f"(sitemap {sitemap_validator})")
+    except sqlite3.Error as e:
+        logger.error(f"Database error when saving high-water mark: {e}")
+
+
+def get_cached_markdown(content_hash):
+    """
+    Retrieve the Markdown converted before from an HTML body with the given hash.
+
+    Args:
+        content_hash (str): The SHA-256 hex digest of the HTML body.
+
+    Returns:
+        str: The cached Markdown or None if the body was not converted before.
+    """
+    cursor = get_cursor()
+
+    try:
+        with db_lock:
+            cursor.execute("SELECT md FROM md_cache WHERE content_hash = ?", (content_hash,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+    except sqlite3.Error as e:
+        logger.error(f"Database error when fetching cached markdown: {e}")
+        return None
+
+
+def save_cached_markdown(content_hash, md):
+    """
+    Store the Markdown converted from an HTML body with the given hash.
+
+    Args:
+        content_hash (str): The SHA-256 hex digest of the HTML body.
+        md (str): The converted Markdown.
+    """
+    cursor = get_cursor()
+
+    try:
+        with db_lock, conn:
+            cursor.execute("INSERT OR REPLACE INTO md_cache (content_hash, md, created_at) VALUES (?, ?, ?)",
+                           (content_hash, md, datetime.now().isoformat()))
+    except sqlite3.Error as e:
+        logger.error(f"Database error when saving cached markdown: {e}")
+
+
+def evict_cached_markdown(max_entries, max_age_days):
+    """
+    Drop the cached Markdown older than max_age_days and the oldest entries beyond max_entries.
+
+    Args:
+        max_entries (int): The number of entries kept.
+        max_age_days (float): The age after which an entry is dropped.
+
+    Returns:
+        int: The number of entries dropped.
+    """
+    cursor = get_cursor()
+
+    try:
+        with db_lock, conn:
+            cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+            expired = cursor.execute("DELETE FROM md_cache WHERE created_at < ?", (cutoff,)).rowcount
+            overflow = cursor.execute("""
+                DELETE FROM md_cache WHERE content_hash IN (
+                    SELECT content_hash FROM md_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (max_entries,)).rowcount
+        if expired or overflow:
+            logger.debug(f"Evicted {expired} expired and {overflow} oldest cached Markdown bodies")
+        return expired + overflow
+    except sqlite3.Error as e:
+        logger.error(f"Database error when evicting cached markdown: {e}")
+        return 0
+
+
+def post_from_row(row):
+    """
+    Build the dictionary of a post from a row of the posts table joined with the encoding and body of post_bodies.
+    """
+    post = dict(row)
+    post['md'] = decode_body(post.pop('encoding'), post.pop('body'))
+    return post
+
 
 def get_recent_unprocessed_posts_by_domain(limit=3):
     """
     Retrieve the most recent unprocessed posts for each domain, limited to a specified number per domain.
+    The posts of every domain are ranked by seeks in the idx_posts_unprocessed index, which only projects
+    their ids, the full rows and the Markdown bodies are read for the selected posts only.
 
     Args:
         limit (int): The maximum number of posts to retrieve per domain. Defaults to 3.
@@ -67,19 +525,22 @@ def get_recent_unprocessed_posts_by_domain(limit=3):
     cursor = get_cursor()
 
     try:
-        cursor.execute("""
-            WITH ranked_posts AS (
-                SELECT *,
-                       ROW_NUMBER() OVER (PARTITION BY domain ORDER BY date DESC) as rank
-                FROM posts
-                WHERE processed = FALSE
-            )
-            SELECT * FROM ranked_posts
-            WHERE rank <= ?
-            ORDER BY domain, date DESC
-        """, (limit,))
-        
-        recent_unprocessed_posts = [dict(row) for row in cursor.fetchall()]
+        with db_lock:
+            # The processed = 0 conditions must match the one of the partial index for the planner to use it
+            cursor.execute("""
+                SELECT posts.*, post_bodies.encoding, post_bodies.body
+                FROM (SELECT DISTINCT domain FROM posts WHERE processed = 0) AS domains
+                JOIN posts ON posts.id IN (
+                    SELECT id FROM posts AS ranked
+                    WHERE ranked.processed = 0 AND ranked.domain IS domains.domain
+                    ORDER BY ranked.date DESC
+                    LIMIT ?
+                )
+                LEFT JOIN post_bodies ON post_bodies.post_id = posts.id
+                ORDER BY posts.domain, posts.date DESC
+            """, (limit,))
+
+            recent_unprocessed_posts = [post_from_row(row) for row in cursor.fetchall()]
         return recent_unprocessed_posts
     except sqlite3.Error as e:
         logger.error(f"Database error when fetching recent unprocessed posts by domain: {e}")
@@ -96,21 +557,152 @@ def get_unprocessed_posts():
     cursor = get_cursor()
 
     try:
-        cursor.execute("""
-            SELECT * FROM posts 
-            WHERE processed = FALSE
-        """)
+        with db_lock:
+            cursor.execute("""
+                SELECT posts.*, post_bodies.encoding, post_bodies.body
+                FROM posts
+                LEFT JOIN post_bodies ON post_bodies.post_id = posts.id
+                WHERE processed = FALSE
+            """)
         
-        unprocessed_posts = [dict(row) for row in cursor.fetchall()]
+            unprocessed_posts = [post_from_row(row) for row in cursor.fetchall()]
         return unprocessed_posts
     except sqlite3.Error as e:
         logger.error(f"Database error when fetching unprocessed posts: {e}")
         return []
 
 
+def lease_posts(cursor, ids, owner, lease_seconds):
+    """
+    Move the given posts to the in_progress state, leased to the owner, and return them with their body.
+    Must be called in the transaction which selected the posts.
+    """
+    lease_expires_at = (datetime.now() + timedelta(seconds=lease_seconds)).isoformat()
+    posts = []
+    for i in range(0, len(ids), URL_LOOKUP_BATCH_SIZE):
+        batch = ids[i:i + URL_LOOKUP_BATCH_SIZE]
+        placeholders = ','.join(['?'] * len(batch))
+        cursor.execute(f"""
+            UPDATE posts
+            SET state = 'in_progress', attempts = attempts + 1, lease_owner = ?, lease_expires_at = ?
+            WHERE id IN ({placeholders})
+        """, (owner, lease_expires_at, *batch))
+        cursor.execute(f"""
+            SELECT posts.*, post_bodies.encoding, post_bodies.body
+            FROM posts
+            LEFT JOIN post_bodies ON post_bodies.post_id = posts.id
+            WHERE posts.id IN ({placeholders})
+            ORDER BY posts.domain, posts.date DESC
+        """, batch)
+        posts.extend(post_from_row(row) for row in cursor.fetchall())
+    return posts
+
+
+def give_up_expired_posts(cursor, max_attempts, now):
+    """
+    Move the posts whose lease expired after their last attempt to the failed state, no summarizer can claim them
+    again and they would stay in_progress forever. Must be called in the claiming transaction.
+    """
+    cursor.execute("""
+        UPDATE posts
+        SET state = 'failed', lease_owner = NULL, lease_expires_at = NULL
+        WHERE processed = 0 AND state = 'in_progress' AND lease_expires_at < ? AND attempts >= ?
+    """, (now, max_attempts))
+    if cursor.rowcount > 0:
+        logger.warning(f"Gave up {cursor.rowcount} posts which were not summarized in {max_attempts} attempts.")
+
+
+def claim_recent_posts(owner, limit=None, per_domain=3, lease_seconds=3600, max_attempts=3):
+    """
+    Claim the most recent posts to summarize of every domain, like get_recent_unprocessed_posts_by_domain.
+    The claimable posts are the pending ones, and the failed ones and the ones whose lease expired (their
+    summarizer stopped) which were attempted less than max_attempts times. The posts are selected and leased
+    in a single write transaction, so the summarizers sharing the database claim disjoint posts. The posts whose
+    lease expired after their last attempt are moved to the failed state in the same transaction.
+
+    Args:
+        owner (str): The identifier of the summarizer claiming the posts.
+        limit (int): The maximum number of posts to claim, all the selected posts when None.
+        per_domain (int): The maximum number of posts to claim per domain.
+        lease_seconds (int): The time after which the posts can be claimed again if they are not done.
+        max_attempts (int): The number of attempts after which a post is not claimed anymore.
+
+    Returns:
+        list: The claimed posts, as dictionaries containing the post data.
+    """
+    cursor = get_cursor()
+
+    try:
+        with db_lock:
+            # Takes the write lock first, another process cannot select the same posts in between
+            cursor.execute("BEGIN IMMEDIATE")
+            with conn:
+                now = datetime.now().isoformat()
+                give_up_expired_posts(cursor, max_attempts, now)
+                cursor.execute("""
+                    SELECT posts.id
+                    FROM (SELECT DISTINCT domain FROM posts WHERE processed = 0) AS domains
+                    JOIN posts ON posts.id IN (
+                        SELECT id FROM posts AS ranked
+                        WHERE ranked.processed = 0 AND ranked.domain IS domains.domain
+                          AND (ranked.state = 'pending'
+                               OR (ranked.attempts < ? AND (ranked.state = 'failed' OR ranked.lease_expires_at < ?)))
+                        ORDER BY ranked.date DESC
+                        LIMIT ?
+                    )
+                    ORDER BY posts.domain, posts.date DESC
+                    LIMIT ?
+                """, (max_attempts, now, per_domain, limit if limit else -1))
+                ids = [row[0] for row in cursor.fetchall()]
+                posts = lease_posts(cursor, ids, owner, lease_seconds)
+        logger.info(f"Claimed {len(posts)} posts.")
+        return posts
+    except sqlite3.Error as e:
+        logger.error(f"Database error when claiming posts: {e}")
+        return []
+
+
+def claim_posts_by_url(owner, urls, lease_seconds=3600, max_attempts=3):
+    """
+    Claim the given posts, see claim_recent_posts. The posts which are done or leased to another summarizer are skipped.
+
+    Args:
+        owner (str): The identifier of the summarizer claiming the posts.
+        urls (list): The URLs of the posts to claim.
+        lease_seconds (int): The time after which the posts can be claimed again if they are not done.
+        max_attempts (int): The number of attempts after which a post is not claimed anymore.
+
+    Returns:
+        list: The claimed posts, as dictionaries containing the post data.
+    """
+    cursor = get_cursor()
+
+    try:
+        with db_lock:
+            cursor.execute("BEGIN IMMEDIATE")
+            with conn:
+                now = datetime.now().isoformat()
+                give_up_expired_posts(cursor, max_attempts, now)
+                ids = []
+                for i in range(0, len(urls), URL_LOOKUP_BATCH_SIZE):
+                    batch = urls[i:i + URL_LOOKUP_BATCH_SIZE]
+                    cursor.execute("""
+                        SELECT id FROM posts
+                        WHERE url IN ({}) AND processed = 0
+                          AND (state = 'pending' OR (attempts < ? AND (state = 'failed' OR lease_expires_at < ?)))
+                    """.format(','.join(['?'] * len(batch))), (*batch, max_attempts, now))
+                    ids.extend(row[0] for row in cursor.fetchall())
+                posts = lease_posts(cursor, ids, owner, lease_seconds)
+        return posts
+    except sqlite3.Error as e:
+        logger.error(f"Database error when claiming posts: {e}")
+        return []
+
+
 def mark_posts_as_processed(urls):
     """
-    Update the 'processed' column to True for the given URLs in the database.
+    Move the posts with the given URLs to the done state and set their 'processed' column to True,
+    in a single transaction.
 
     Args:
         urls (list): A list of URLs to mark as processed.
@@ -121,25 +713,17 @@ def mark_posts_as_processed(urls):
     cursor = get_cursor()
 
     try:
-        batch_size = 10
         total_rows_affected = 0
 
-        for i in range(0, len(urls), batch_size):
-            batch = urls[i:i+batch_size]
-            
-            # Prepare the update query for this batch
-            query = '''
-                UPDATE posts
-                SET processed = TRUE
-                WHERE url IN ({})
-            '''.format(','.join(['?'] * len(batch)))
-
-            # Execute the update for this batch
-            cursor.execute(query, batch)
-            conn.commit()
-
-            # Add the number of rows affected in this batch
-            total_rows_affected += cursor.rowcount
+        with db_lock, conn:
+            for i in range(0, len(urls), URL_LOOKUP_BATCH_SIZE):
+                batch = urls[i:i + URL_LOOKUP_BATCH_SIZE]
+                cursor.execute("""
+                    UPDATE posts
+                    SET processed = TRUE, state = 'done', lease_owner = NULL, lease_expires_at = NULL
+                    WHERE url IN ({})
+                """.format(','.join(['?'] * len(batch))), batch)
+                total_rows_affected += cursor.rowcount
 
         logger.info(f"Marked {total_rows_affected} posts as processed.")
         return total_rows_affected
@@ -148,97 +732,306 @@ def mark_posts_as_processed(urls):
         return 0
 
 
-def save_summary_to_db(summary):
+def mark_posts_as_failed(owner, urls):
+    """
+    Move the posts with the given URLs, leased to the owner, to the failed state, in a single transaction.
+    They are claimed again by the next runs until they reach the maximum number of attempts.
+
+    Args:
+        owner (str): The identifier of the summarizer which claimed the posts.
+        urls (list): A list of URLs of the posts which were not summarized.
+
+    Returns:
+        int: The number of posts marked as failed.
+    """
     cursor = get_cursor()
-    
-    # Create table if it doesn't exist
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS summaries (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            url TEXT UNIQUE,
-            title TEXT,
-            subtitle TEXT,
-            domain TEXT,
-            date TEXT,
-            summary TEXT,
-            category TEXT,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+
+    try:
+        total_rows_affected = 0
+
+        with db_lock, conn:
+            for i in range(0, len(urls), URL_LOOKUP_BATCH_SIZE):
+                batch = urls[i:i + URL_LOOKUP_BATCH_SIZE]
+                # The posts whose lease expired and which were claimed by another summarizer are left to it
+                cursor.execute("""
+                    UPDATE posts
+                    SET state = 'failed', lease_owner = NULL, lease_expires_at = NULL
+                    WHERE url IN ({}) AND state = 'in_progress' AND lease_owner = ?
+                """.format(','.join(['?'] * len(batch))), (*batch, owner))
+                total_rows_affected += cursor.rowcount
+
+        if total_rows_affected:
+            logger.info(f"Marked {total_rows_affected} posts as failed.")
+        return total_rows_affected
+    except sqlite3.Error as e:
+        logger.error(f"Database error when marking posts as failed: {e}")
+        return 0
+
+
+def search_posts(query, limit=10):
+    """
+    Search the posts and their summaries in the full-text index, ranked by BM25 (the matches in the titles
+    and the summaries weigh more than the ones in the bodies). The query uses the FTS5 syntax (AND, OR, NOT,
+    "phrases", prefix*), a query which is not valid in it is searched as a list of words.
+
+    Args:
+        query (str): The words to search for.
+        limit (int): The maximum number of posts to return. Defaults to 10.
+
+    Returns:
+        list: A list of dictionaries with the url, title, subtitle, domain, date, summary and score (the BM25
+            rank, lower is better) of the matching posts, best first, and a snippet of the matching text.
+    """
+    cursor = get_cursor()
+    # The posts and the summaries are ranked by their own index, the scores of a post matching in both add up.
+    # The snippets are only built for the best matches, from the post when it matches, else from the summary.
+    search = """
+        WITH matches AS (
+            SELECT rowid AS id, rank FROM posts_fts WHERE posts_fts MATCH :query
+            UNION ALL
+            SELECT posts.id, summaries_fts.rank
+            FROM summaries_fts
+            JOIN summaries ON summaries.id = summaries_fts.rowid
+            JOIN posts ON posts.url = summaries.url
+            WHERE summaries_fts MATCH :query
+        ),
+        ranked AS (
+            SELECT id, SUM(rank) AS score FROM matches GROUP BY id ORDER BY score LIMIT :limit
         )
-    ''')
-    # Prepare the insert/update query
+        SELECT posts.url, posts.title, posts.subtitle, posts.domain, posts.date, summaries.summary,
+               COALESCE(
+                   (SELECT snippet(posts_fts, -1, '[', ']', '...', 16) FROM posts_fts
+                    WHERE posts_fts MATCH :query AND rowid = ranked.id),
+                   (SELECT snippet(summaries_fts, 0, '[', ']', '...', 16) FROM summaries_fts
+                    WHERE summaries_fts MATCH :query AND rowid = summaries.id)
+               ) AS snippet,
+               ranked.score
+        FROM ranked
+        JOIN posts ON posts.id = ranked.id
+        LEFT JOIN summaries ON summaries.url = posts.url
+        ORDER BY ranked.score
+    """
+
+    try:
+        with db_lock:
+            try:
+                cursor.execute(search, {'query': query, 'limit': limit})
+            except sqlite3.OperationalError:
+                # Not a valid FTS5 query, for example with punctuation: every word is quoted
+                words = ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
+                cursor.execute(search, {'query': words, 'limit': limit})
+            return [dict(row) for row in cursor.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Database error when searching posts: {e}")
+        return []
+
+
+def iter_summaries(categories=None, since=None, after_id=0):
+    """
+    Stream the summaries written since a date, grouped by category, reading them from the database a page at a time.
+    The summaries in other categories and the ones of posts without content are skipped.
+
+    Args:
+        categories (list): The categories to include, in the order of the digest. All of them when empty.
+        since (datetime): The UTC time from which the summaries were written, all of them when None.
+        after_id (int): Only the summaries with a greater id (written after it) are returned.
+
+    Yields:
+        dict: The id, url, title, domain, summary and lower-cased category of the summaries, ordered by category
+            and creation time.
+    """
+    cursor = get_cursor()
+    if categories:
+        # The position of the category in the list orders the digest, the other categories have none
+        position = 'CASE LOWER(category) {} END'.format(' '.join(['WHEN ? THEN ?'] * len(categories)))
+        parameters = [value for index, name in enumerate(categories) for value in (name.lower(), index)]
+    else:
+        position, parameters = 'LOWER(category)', []
+    parameters += [after_id, since.strftime('%Y-%m-%d %H:%M:%S') if since else '',
+                   '%Unfortunately, no content was provided to summarize or categorize%']
+
+    with db_lock:
+        cursor.execute(f"""
+            SELECT id, url, title, domain, summary, LOWER(category) AS category, {position} AS position
+            FROM summaries
+            WHERE id > ? AND created_at >= ? AND summary NOT LIKE ? AND position IS NOT NULL
+            ORDER BY position, created_at, id
+        """, parameters)
+    while True:
+        with db_lock:
+            rows = cursor.fetchmany(WRITE_BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield dict(row)
+
+
+def get_digest_mark(digest):
+    """
+    Retrieve the id of the last summary published in the given digest.
+
+    Args:
+        digest (str): The name of the digest.
+
+    Returns:
+        int: The id of the last summary published, 0 if the digest was never generated.
+    """
+    cursor = get_cursor()
+
+    try:
+        with db_lock:
+            cursor.execute("SELECT last_summary_id FROM digest_state WHERE digest = ?", (digest,))
+            row = cursor.fetchone()
+        return row[0] if row and row[0] else 0
+    except sqlite3.Error as e:
+        logger.error(f"Database error when fetching the digest mark: {e}")
+        return 0
+
+
+def set_digest_mark(digest, last_summary_id):
+    """
+    Store the id of the last summary published in the given digest.
+
+    Args:
+        digest (str): The name of the digest.
+        last_summary_id (int): The id of the last summary published.
+    """
+    cursor = get_cursor()
+
+    try:
+        with db_lock, conn:
+            cursor.execute("""
+                INSERT INTO digest_state (digest, last_summary_id, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(digest) DO UPDATE SET last_summary_id = excluded.last_summary_id, updated_at = excluded.updated_at
+            """, (digest, last_summary_id, datetime.now().isoformat()))
+    except sqlite3.Error as e:
+        logger.error(f"Database error when saving the digest mark: {e}")
+
+
+def save_summary_to_db(summary):
+    """
+    Insert or update a single summary, see save_summaries_to_db.
+    """
+    return save_summaries_to_db([summary]) == 1
+
+
+def save_summaries_to_db(summaries):
+    """
+    Insert or update summaries, keyed by URL, in batched transactions.
+
+    Args:
+        summaries (list): The summaries to save.
+
+    Returns:
+        int: The number of summaries saved.
+    """
+    cursor = get_cursor()
     query = '''
-        INSERT OR REPLACE INTO summaries
-        (url, title, subtitle, domain, date, summary, category)
+        INSERT INTO summaries (url, title, subtitle, domain, date, summary, category)
         VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(url) DO UPDATE SET
+            title = excluded.title,
+            subtitle = excluded.subtitle,
+            domain = excluded.domain,
+            date = excluded.date,
+            summary = excluded.summary,
+            category = excluded.category
     '''
+    rows = [(
+        summary.get('url', ''),
+        summary.get('title', ''),
+        summary.get('subtitle', ''),
+        summary.get('domain', ''),
+        summary.get('date', ''),
+        summary.get('summary', ''),
+        summary.get('category', '')
+    ) for summary in summaries]
 
     try:
-        cursor.execute(query, (
-            summary.get('url', ''),
-            summary.get('title', ''),
-            summary.get('subtitle', ''),
-            summary.get('domain', ''),
-            summary.get('date', ''),
-            summary.get('summary', ''),
-            summary.get('category', '')
-        ))
-        conn.commit()
-        logger.info(f"Saved/updated summary for URL: {summary.get('url')}")
-        return True
+        with db_lock:
+            for i in range(0, len(rows), WRITE_BATCH_SIZE):
+                with conn:
+                    cursor.executemany(query, rows[i:i + WRITE_BATCH_SIZE])
+        for summary in summaries:
+            logger.info(f"Saved/updated summary for URL: {summary.get('url')}")
+        return len(rows)
     except sqlite3.Error as e:
         logger.error(f"Database error when saving summary: {e}")
-        return False
-    
+        return 0
 
 
 def save_posts_to_db(posts_data):
-    cursor = get_cursor()
-
-    # Create table if it doesn't exist
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS posts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            domain TEXT,
-            blog_title TEXT,
-            url TEXT UNIQUE,
-            title TEXT,
-            subtitle TEXT,
-            like_count INTEGER,
-            date TEXT,
-            md TEXT,
-            source TEXT,
-            created_at TEXT,
-            updated_at TEXT,
-            processed BOOLEAN DEFAULT FALSE
-        )
-    ''')
+    """
+    Insert or update scraped posts, keyed by URL, in batched transactions.
+    The creation time and the processing state of existing posts are kept.
+    The Markdown bodies are written to the post_bodies table, compressed with the configured compression,
+    and the posts are indexed for the search from their uncompressed text.
 
-    # Prepare the insert/update query
+    Args:
+        posts_data (list): The posts to save.
+    """
+    cursor = get_cursor()
     query = '''
-        INSERT OR REPLACE INTO posts 
-        (domain, blog_title, url, title, subtitle, like_count, date, md, source, created_at, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE((SELECT created_at FROM posts WHERE url = ?), ?), ?)
+        INSERT INTO posts
+        (domain, blog_title, url, title, subtitle, like_count, date, source, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(url) DO UPDATE SET
+            domain = excluded.domain,
+            blog_title = excluded.blog_title,
+            title = excluded.title,
+            subtitle = excluded.subtitle,
+            like_count = excluded.like_count,
+            date = excluded.date,
+            source = excluded.source,
+            updated_at = excluded.updated_at
+    '''
+    body_query = '''
+        INSERT INTO post_bodies (post_id, encoding, body)
+        SELECT id, ?, ? FROM posts WHERE url = ?
+        ON CONFLICT(post_id) DO UPDATE SET
+            encoding = excluded.encoding,
+            body = excluded.body
+    '''
+    # The indexed text of a post saved before is removed with its stored values (only then is the body decoded)
+    unindex_query = '''
+        INSERT INTO posts_fts (posts_fts, rowid, title, subtitle, body)
+        SELECT 'delete', id, title, subtitle, body FROM post_search
+        WHERE id = (SELECT id FROM posts WHERE url = ?)
+    '''
+    index_query = '''
+        INSERT INTO posts_fts (rowid, title, subtitle, body)
+        SELECT id, ?, ?, ? FROM posts WHERE url = ?
     '''
 
     current_time = datetime.now().isoformat()
+    rows = [(
+        post.get('domain', ''),
+        post.get('blog_title', ''),
+        post.get('url', ''),
+        post.get('title', ''),
+        post.get('subtitle', ''),
+        post.get('like_count', 0),
+        post.get('date', ''),
+        'Substack',  # Source is set to 'Substack' for this scraper
+        current_time,  # created_at (only used for new posts)
+        current_time   # updated_at
+    ) for post in posts_data]
+    # Compressed here, outside of the lock
+    body_rows = [(*encode_body(post.get('md', '')), post.get('url', '')) for post in posts_data]
+    # The last version of a post listed twice is the one indexed
+    index_rows = list({post.get('url', ''): (post.get('title', ''), post.get('subtitle', ''), post.get('md', ''),
+                                              post.get('url', '')) for post in posts_data}.values())
 
-    # Insert or update each post
-    for post in posts_data:
-        cursor.execute(query, (
-            post.get('domain', ''),
-            post.get('blog_title', ''),
-            post.get('url', ''),
-            post.get('title', ''),
-            post.get('subtitle', ''),
-            post.get('like_count', 0),
-            post.get('date', ''),
-            post.get('md', ''),
-            'Substack',  # Source is set to 'Substack' for this scraper
-            post.get('url', ''),  # For checking if the post already exists
-            current_time,  # created_at (only used for new posts)
-            current_time   # updated_at
-        ))
-
-    conn.commit()
+    with db_lock:
+        for i in range(0, len(rows), WRITE_BATCH_SIZE):
+            batch_urls = {row[2] for row in rows[i:i + WRITE_BATCH_SIZE]}
+            with conn:
+                cursor.execute("SELECT url FROM posts WHERE url IN ({})".format(','.join(['?'] * len(batch_urls))),
+                               tuple(batch_urls))
+                existing_urls = [(row[0],) for row in cursor.fetchall()]
+                cursor.executemany(unindex_query, existing_urls)
+                cursor.executemany(query, rows[i:i + WRITE_BATCH_SIZE])
+                cursor.executemany(body_query, body_rows[i:i + WRITE_BATCH_SIZE])
+                cursor.executemany(index_query, [row for row in index_rows if row[3] in batch_urls])
 
     logger.info(f"Saved {len(posts_data)} posts to the database.")
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# ok: the response is usable, path: file holding the body, not_modified: the server answered 304,
+# validator: the ETag (or Last-Modified date) of the cached body
+CachedResponse = namedtuple('CachedResponse', ['ok', 'status_code', 'path', 'not_modified', 'validator'])
+
+
+class HttpCache:
+    """
+    On-disk HTTP cache revalidated with conditional requests (ETag / Last-Modified).
+    Bodies are streamed to disk, so large documents never have to be held in memory.
+    """
+    def __init__(self, cache_dir: str, chunk_size: int = 64 * 1024):
+        self.cache_dir = cache_dir
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, url: str) -> tuple[str, str]:
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{key}.body'), os.path.join(self.cache_dir, f'{key}.json')
+
+    def _load_meta(self, meta_path: str) -> dict:
+        try:
+            with open(meta_path, 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return dict()
+
+    def fetch(self, http, url: str) -> CachedResponse:
+        """
+        Fetches the URL with a conditional request if it was cached before
+
+        Args:
+            http: Session-like object providing get(url, headers=..., stream=...)
+            url (str): The URL to fetch
+
+        Returns:
+            CachedResponse: The status of the response and the path of the cached body
+        """
+        body_path, meta_path = self._paths(url)
+        meta = self._load_meta(meta_path) if os.path.exists(body_path) else dict()
+        headers = dict()
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        with http.get(url, headers=headers, stream=True) as rsp:
+            if rsp.status_code == 304:
+                logger.debug(f'Not modified since {meta.get("fetched_at")}: {url}')
+                return CachedResponse(True, 304, body_path, True, meta.get('etag') or meta.get('last_modified'))
+            if not rsp.ok:
+                return CachedResponse(False, rsp.status_code, None, False, None)
+            tmp_path = f'{body_path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                for chunk in rsp.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+            meta = {
+                'url': url,
+                'etag': rsp.headers.get('ETag'),
+                'last_modified': rsp.headers.get('Last-Modified'),
+                'fetched_at': datetime.now().isoformat()
+            }
+        with self._lock:
+            os.replace(tmp_path, body_path)
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        return CachedResponse(True, 200, body_path, False, meta['etag'] or meta['last_modified'])
@@ -0,0 +1,54 @@
+LEADING_FENCE = '```json'
+
+
+class JsonObjectTracker:
+    """
+    Follows the text of a streamed completion and tells when the JSON object it starts with is complete,
+    so the rest of the stream does not have to be read. Completions which do not start with a JSON object
+    (optionally in a ```json fence) are never reported complete.
+    Once complete, `end` is the offset in the whole text fed so far right after the closing brace of the object.
+    """
+    def __init__(self):
+        self.active = True
+        self.complete = False
+        self.end = None
+        self._offset = 0
+        self._lead = ''
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text: str) -> bool:
+        """
+        Consumes the next piece of the completion, returns True once the object is complete
+        """
+        if not self.active or self.complete:
+            return self.complete
+        for index, char in enumerate(text):
+            if self._depth == 0:
+                if char == '{':
+                    self._depth = 1
+                elif not char.isspace():
+                    self._lead += char
+                    if not LEADING_FENCE.startswith(self._lead):
+                        self.active = False
+                        return False
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == '{':
+                self._depth += 1
+            elif char == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    self.complete = True
+                    self.end = self._offset + index + 1
+                    return True
+        self._offset += len(text)
+        return False
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Persistent cache of LLM completions stored in its own SQLite database.
+    Entries are keyed on the hash of everything which determines the completion: provider, model,
+    rendered system and user prompts, temperature and max_tokens.
+    Entries older than `max_age_days` are evicted, and the least recently used ones beyond `max_entries`.
+    """
+    EVICT_EVERY = 100  # writes between two eviction passes
+
+    def __init__(self, database_file: str, max_entries: int = 10000, max_age_days: float = 30):
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 3600
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.conn = sqlite3.connect(database_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        with self.conn:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    content TEXT,
+                    tokens_used INTEGER,
+                    created_at REAL,
+                    last_used_at REAL
+                )
+            ''')
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used_at ON responses (last_used_at)")
+        self.evict()
+
+    @staticmethod
+    def key(provider: str, model: str, prompt: str, system_prompt: Optional[str], temperature: float, max_tokens: int, **extra) -> str:
+        """
+        Hashes the inputs of a completion. Extra request options (e.g. the response format) are part of the key.
+        """
+        material = json.dumps([provider, model, system_prompt or '', prompt, temperature, max_tokens, extra],
+                              sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute("SELECT content, tokens_used, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or row[2] < now - self.max_age:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            with self.conn:
+                self.conn.execute("UPDATE responses SET last_used_at = ? WHERE key = ?", (now, key))
+        return {'content': row[0], 'tokens_used': row[1], 'cached': True}
+
+    def put(self, key: str, model: str, response: dict):
+        now = time.time()
+        with self._lock:
+            with self.conn:
+                self.conn.execute('''
+                    INSERT OR REPLACE INTO responses (key, model, content, tokens_used, created_at, last_used_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (key, model, response.get('content', ''), response.get('tokens_used'), now, now))
+            self._writes += 1
+            evict = self._writes % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def delete(self, key: str):
+        """
+        Drops an entry, e.g. an output which turned out to be invalid
+        """
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+
+    def evict(self):
+        """
+        Drops the expired entries and the least recently used ones beyond max_entries
+        """
+        with self._lock, self.conn:
+            expired = self.conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age,)).rowcount
+            overflow = self.conn.execute('''
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,)).rowcount
+            self.stats['evictions'] += expired + overflow
+        if expired or overflow:
+            logger.debug(f'Evicted {expired} expired and {overflow} least recently used responses')
+
+    def log_stats(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / lookups * 100 if lookups else 0
+        logger.info(f"Response cache: {self.stats['hits']} hits, {self.stats['misses']} misses ({hit_rate:.0f}% hit rate), "
+                    f"{self.stats['evictions']} evictions")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -0,0 +1,91 @@
+import logging
+import re
+from functools import lru_cache
+from typing import List, Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Lines of the header written by html_to_md which carry no information for a summary
+DATE_LINE = re.compile(r'^\*\*[^*\n]*\*\*$')
+LIKES_LINE = re.compile(r'^\*\*Likes:\*\*.*$')
+# Substack call to action links which are repeated in every post
+CALL_TO_ACTION_LINE = re.compile(
+    r'^\[(Subscribe now|Share|Leave a comment|Give a gift subscription|Share [^\]]*|Upgrade to paid)\]\([^)]*\)$',
+    re.IGNORECASE)
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: Optional[str]):
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except (KeyError, TypeError):
+        # Ollama and unknown models: an OpenAI encoding is still a far better estimate than the heuristic
+        return tiktoken.get_encoding('cl100k_base')
+
+
+def count_tokens(text: Optional[str], model: Optional[str] = None) -> int:
+    """
+    Counts the tokens of a text for a model with tiktoken when it is installed,
+    otherwise estimates them (about 4 characters per token for English)
+    """
+    if not text:
+        return 0
+    encoding = _encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def strip_boilerplate(md: str) -> str:
+    """
+    Removes the date and likes header written by html_to_md and the Substack call to action links,
+    the title and subtitle are kept as they help the summary
+    """
+    lines = md.split('\n')
+    # The likes line closes the header
+    end = next((index + 1 for index, line in enumerate(lines[:8]) if LIKES_LINE.match(line.strip())), 0)
+    header = [line for line in lines[:end] if not (DATE_LINE.match(line.strip()) or LIKES_LINE.match(line.strip()))]
+    body = [line for line in lines[end:] if not CALL_TO_ACTION_LINE.match(line.strip())]
+    return re.sub(r'\n{3,}', '\n\n', '\n'.join(header + body)).strip()
+
+
+def _split_long_text(text: str, chunk_tokens: int, tokens: int) -> List[str]:
+    # Cuts a text without line breaks at the spaces closest to the chunk size
+    size = max(1, len(text) * chunk_tokens // tokens)
+    pieces = []
+    while len(text) > size:
+        cut = text.rfind(' ', 0, size)
+        cut = cut if cut > 0 else size
+        pieces.append(text[:cut])
+        text = text[cut:].lstrip()
+    return pieces + [text]
+
+
+def split_into_chunks(md: str, chunk_tokens: int, model: Optional[str] = None) -> List[str]:
+    """
+    Splits a Markdown text on paragraph boundaries into chunks of about chunk_tokens tokens,
+    a paragraph longer than a chunk is split on lines, and a line longer than a chunk on spaces
+    """
+    chunks, current, current_tokens = [], [], 0
+    for paragraph in md.split('\n\n'):
+        pieces = []
+        for line in (paragraph.split('\n') if count_tokens(paragraph, model) > chunk_tokens else [paragraph]):
+            tokens = count_tokens(line, model)
+            pieces.extend(_split_long_text(line, chunk_tokens, tokens) if tokens > chunk_tokens else [line])
+        for piece in pieces:
+            tokens = count_tokens(piece, model)
+            if current and current_tokens + tokens > chunk_tokens:
+                chunks.append('\n\n'.join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        chunks.append('\n\n'.join(current))
+    return chunks
@@ -1,16 +1,86 @@
 import logging
+import hashlib
+import multiprocessing
+import threading
 import html2text
-from jinja2 import Environment, FileSystemLoader
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, groupby
+from typing import Callable, Optional
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, Template
+from datetime import datetime, timedelta, timezone
 import os
-import json
+import uuid
+from driver.utils.dbops import evict_cached_markdown, get_cached_markdown, get_digest_mark, iter_summaries, \
+    save_cached_markdown, set_digest_mark
 
 
 logger = logging.getLogger(__name__)
 
-def html_to_md(title: str, subtitle: str, date: str, like_count: str, html_content: str) -> str:
+TEMPLATES_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'etc', 'templates')
+
+# html2text converters are reused by the thread (or pool process) which created them
+_converters = threading.local()
+
+def html_body_to_md(html_content: str) -> str:
+    """
+    Converts an HTML fragment to Markdown with the converter of the current thread
+    """
+    converter = getattr(_converters, 'converter', None)
+    if converter is None:
+        converter = html2text.HTML2Text()
+        converter.ignore_links = False
+        converter.body_width = 0
+        _converters.converter = converter
+    return converter.handle(html_content)
+
+class MarkdownConverter:
     """
-    This method converts HTML to Markdown
+    Converts post bodies to Markdown, skipping the conversion of bodies seen before.
+    The Markdown is cached in the database keyed by the hash of the HTML body, the entries older than `cache_max_age_days`
+    and the oldest ones beyond `cache_max_entries` are evicted when the converter is closed.
+    With `processes` > 0 the conversion runs in a process pool, in parallel with the network I/O of the scraper threads.
+    """
+    def __init__(self, processes: int = 0, cache: bool = True, cache_max_entries: int = 2000,
+                 cache_max_age_days: float = 30):
+        self.cache = cache
+        self.cache_max_entries = cache_max_entries
+        self.cache_max_age_days = cache_max_age_days
+        # the pool is started from the scraper threads, forking a multi-threaded process is not safe
+        self.pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) \
+            if processes > 0 else None
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, html_content: str) -> str:
+        content_hash = hashlib.sha256(html_content.encode('utf-8')).hexdigest()
+        md_content = get_cached_markdown(content_hash) if self.cache else None
+        if md_content is not None:
+            self._count('hits')
+            return md_content
+        self._count('misses')
+        md_content = self.pool.submit(html_body_to_md, html_content).result() if self.pool else html_body_to_md(html_content)
+        if self.cache:
+            save_cached_markdown(content_hash, md_content)
+        return md_content
+
+    def _count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+        if self.cache:
+            self.stats['evictions'] += evict_cached_markdown(self.cache_max_entries, self.cache_max_age_days)
+        logger.info(f"Markdown conversion cache: {self.stats['hits']} hits, {self.stats['misses']} misses, "
+                    f"{self.stats['evictions']} evictions")
+
+def html_to_md(title: str, subtitle: str, date: str, like_count: str, html_content: str,
+               converter: Callable[[str], str] = html_body_to_md) -> str:
+    """
+    This method converts HTML to Markdown, the body is converted by `converter`
     """
     def combine_metadata_and_content(content: str) -> str:
         """
@@ -31,43 +101,73 @@ def html_to_md(title: str, subtitle: str, date: str, like_count: str, html_conte
         return metadata + content
     if not isinstance(html_content, str):
         raise ValueError("html_content must be a string")
-    h = html2text.HTML2Text()
-    h.ignore_links = False
-    h.body_width = 0
-    md_content = h.handle(html_content)
+    md_content = converter(html_content)
     return combine_metadata_and_content(md_content)
 
-def generate_html_summary(summary_data: dict, data_folder: str):
-    # Set up Jinja2 environment
-    env = Environment(loader=FileSystemLoader('etc/templates'))
-    template = env.get_template('summary_template.html')
-
-    # Group summaries by category
-    categories = {}
-    for category, items in summary_data.items():
-        category = category.title()
-        categories[category] = []
-        for item in items:
-            categories[category].append({
+@lru_cache(maxsize=None)
+def digest_template(cache_dir: str) -> Template:
+    """
+    Returns the template of the digest, compiled once per process, the compiled code is kept in a bytecode cache between runs
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    env = Environment(loader=FileSystemLoader(TEMPLATES_FOLDER), bytecode_cache=FileSystemBytecodeCache(cache_dir))
+    return env.get_template('summary_template.html')
+
+def generate_html_summary(data_folder: str, configuration: dict) -> Optional[str]:
+    """
+    Writes the digest of the summaries which were not published yet, for the window of the digest object of the configuration:
+    - window_days: only the summaries written in the last days are included
+    - incremental: the summaries published by the previous digests are left out, otherwise the whole window is published
+    The summaries are streamed from the database into the template, which is streamed to the file.
+    Returns the path of the digest, None when there is no summary to publish.
+    """
+    digest_configuration = configuration.get('digest', {})
+    window_days = digest_configuration.get('window_days', 7)
+    after_id = get_digest_mark('html') if digest_configuration.get('incremental', True) else 0
+    since = datetime.now(timezone.utc) - timedelta(days=window_days) if window_days else None
+    summaries = iter_summaries(configuration.get('categories', []), since, after_id)
+
+    first = next(summaries, None)
+    if first is None:
+        logger.info("No new summaries to publish, the digest is not generated")
+        return None
+    last_id = 0
+
+    def items(group):
+        nonlocal last_id
+        for item in group:
+            last_id = max(last_id, item['id'])
+            yield {
                 'domain': item['domain'].upper(),
                 'summary': item['summary'],
                 'title': item['title'].capitalize(),
                 'url': item['url']
-            })
-
-    # Render the template
-    html_content = template.render(categories=categories)
+            }
 
-    # Generate filename with current date
-    current_date = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-    filename = f"{current_date}_summary.html"
+    # Group summaries by category, lazily: the template pulls them as it is rendered
+    categories = ((category.title(), items(group))
+                  for category, group in groupby(chain([first], summaries), key=lambda item: item['category']))
 
     # Ensure the directory exists
     content_folder = os.path.join(data_folder, 'summaries')
     os.makedirs(content_folder, exist_ok=True)
 
-    # Write the HTML file
-    with open(os.path.join(content_folder, filename), 'w', encoding='utf-8') as f:
-        f.write(html_content)
+    # Render the template into a temporary file of its own, the digest only appears once it is complete
+    template = digest_template(os.path.join(data_folder, 'jinja_cache'))
+    temp_path = os.path.join(content_folder, f"{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            template.stream(categories=categories).dump(f)
+        # The id of the last summary published tells the digests of the same second apart
+        filename = f"{datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}_{last_id}_summary.html"
+        path = os.path.join(content_folder, filename)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    # Only a published digest moves the mark, the summaries of a failed one are published by the next
+    set_digest_mark('html', last_id)
 
     logger.info(f"Generated HTML summary: {filename}")
+    return path
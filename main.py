@@ -2,9 +2,12 @@ import logging
 import logging.config
 import os, argparse
 import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from driver.agents import process_posts
 from driver.client import AIClient
-from driver.utils.dbops import initialize_db
+from driver.utils.responsecache import ResponseCache
+from driver.utils.dbops import initialize_db, search_posts
 from driver.scrapers.substack import scrape_substack
 from driver.utils.utils import generate_html_summary
 
@@ -68,7 +71,7 @@ def load_configuration():
             logger.error(f"Error parsing {config_file}. Make sure it's valid JSON")
             raise x
 
-def scrape_substacks(configuration: dict, posts_to_scrape: int):
+def scrape_substacks(configuration: dict, posts_to_scrape: int, data_folder: str, on_saved=None):
     substacks = configuration.get('scrapers', {}).get('substacks', [])
     email = os.environ.get('SUBSTACK_EMAIL')
     password = os.environ.get('SUBSTACK_PASSWORD')
@@ -78,7 +81,53 @@ def scrape_substacks(configuration: dict, posts_to_scrape: int):
     scrape_substack(substacks,
                         project_dir=project_root,
                         num_posts_to_scrape=posts_to_scrape, 
-                        authentication=authentication)
+                        authentication=authentication,
+                        concurrency=configuration.get('scrapers', {}).get('concurrency'),
+                        data_folder=data_folder,
+                        html_parser=configuration.get('scrapers', {}).get('parser', 'auto'),
+                        markdown=configuration.get('scrapers', {}).get('markdown'),
+                        save_batch_size=configuration.get('scrapers', {}).get('save_batch_size', 20),
+                        on_saved=on_saved)
+
+def run_pipeline(configuration: dict, posts_to_scrape: int, posts_to_process: int, data_folder: str,
+                 summaries_file: str, client: AIClient):
+    """
+    Scrapes and summarizes at the same time: the posts saved by the scraper flow through a bounded queue
+    into the summarization workers, a full queue holds back the crawl
+    """
+    post_queue = queue.Queue(maxsize=configuration.get('pipeline', {}).get('queue_size', 50))
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipeline') as executor:
+        summarizer = executor.submit(process_posts, limit=posts_to_process, summaries_file=summaries_file,
+                                     client=client, configuration=configuration, post_queue=post_queue)
+
+        def put(post):
+            # Stop feeding a summarizer which failed, its exception is raised below
+            while not summarizer.done():
+                try:
+                    post_queue.put(post, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+        def on_saved(posts):
+            for post in posts:
+                put(post)
+
+        try:
+            scrape_substacks(configuration, posts_to_scrape, data_folder, on_saved=on_saved)
+        finally:
+            put(None)
+        summarizer.result()
+
+def search(query: str, limit: int):
+    results = search_posts(query, limit)
+    if not results:
+        print(f"No post matches {query}")
+    for result in results:
+        print(f"{result['date'][:10] if result['date'] else '':10}  {result['title']}  {result['url']}")
+        if result['summary']:
+            print(f"    {result['summary']}")
+        print(f"    {result['snippet']}\n")
 
 def set_log_level(log_level: str):
     log_level = getattr(logging, log_level.upper())
@@ -99,11 +148,15 @@ def main():
         parser = argparse.ArgumentParser(description='Scrape and process Substack posts.')
         parser.add_argument('--posts_to_scrape', type=int, default=5, help='Number of posts to scrape', nargs='?')
         parser.add_argument('--posts_to_process', type=int, default=5, help='Number of posts to process', nargs='?')
-        parser.add_argument('--steps', nargs='+', default=['all'], choices=['all', 'scrape', 'summarize', 'generate'], 
-                            help='Steps to execute. Can be "all", "scrape", "summarize", "generate", or any combination.')
+        parser.add_argument('--steps', nargs='+', default=['all'], choices=['all', 'scrape', 'summarize', 'generate', 'search'], 
+                            help='Steps to execute. Can be "all", "scrape", "summarize", "generate", or any combination. "search" searches the saved posts for --query.')
+        parser.add_argument('--query', type=str, help='Words to search for in the posts and summaries (with the search step)', nargs='?')
+        parser.add_argument('--search_limit', type=int, default=10, help='Number of posts returned by the search step', nargs='?')
         parser.add_argument('--data_folder', type=str, default=f'{project_root}/data', help='Path to the data folder', nargs='?')
         parser.add_argument('--model', type=str, help='Select the model to use', nargs='?')
         parser.add_argument('--client', type=str, default='ollama', help='Select the client to use. The default is ollama', choices=['ollama', 'openai'], nargs='?')
+        parser.add_argument('--pipeline', action='store_true', help='Summarize the posts while they are scraped (with the scrape and summarize steps)')
+        parser.add_argument('--batch', action='store_true', help='Summarize the posts through the Batch API (slower, at a lower cost)')
         parser.add_argument('--log-level', type=str, default='INFO', help='Select the log level. The default is INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], nargs='?')
         args = parser.parse_args()
         set_log_level(args.log_level)
@@ -118,34 +171,46 @@ def main():
         database_file = f'{args.data_folder}/media_posts.db'
         
         configuration = load_configuration()
-        initialize_db(database_file)
+        if args.batch:
+            configuration['summarize_batch'] = {**configuration.get('summarize_batch', {}), 'enabled': True}
+        initialize_db(database_file, compression=configuration.get('database', {}).get('compression'))
 
-        client = AIClient(client_type=args.client, model=args.model)
+        cache_configuration = dict(configuration.get('response_cache', {}))
+        cache = ResponseCache(f'{args.data_folder}/llm_cache.db', **cache_configuration) \
+            if cache_configuration.pop('enabled', True) else None
+        client = AIClient(client_type=args.client, model=args.model, cache=cache,
+                          rate_limits=configuration.get('rate_limits'),
+                          ollama_format=configuration.get('structured_output', {}).get('ollama_format', 'schema'))
 
         logger.info(f"Steps to execute: {args.steps}")
         logger.info(f"Number of posts to scrape: {args.posts_to_scrape}")
         logger.info(f"Number of posts to process: {args.posts_to_process}")
         
+        steps = args.steps
+        if args.pipeline and ('all' in steps or {'scrape', 'summarize'} <= set(steps)):
+            logger.info('Start scraping and summarizing')
+            run_pipeline(configuration, args.posts_to_scrape, args.posts_to_process, args.data_folder, summaries_file, client)
+            steps = ['generate'] if 'all' in steps or 'generate' in steps else []
+        elif args.pipeline:
+            logger.warning("--pipeline needs both the scrape and summarize steps, the steps are run one after the other")
+
         # Generate a match statement for executing steps based on configuration
-        for step in args.steps:
+        for step in steps:
             match step:
                 case "scrape" | "all":
                     logger.info('Start scraping')
-                    scrape_substacks(configuration, args.posts_to_scrape)
+                    scrape_substacks(configuration, args.posts_to_scrape, args.data_folder)
                 case "summarize" | "all":
                     logger.info('Start summarizing')
                     process_posts(limit=args.posts_to_process, summaries_file=summaries_file, client=client, configuration=configuration)
                 case "generate" | "all":
                     logger.info('Start generating')
-                    try:
-                        with open(summaries_file, 'r') as f:
-                            summaries_bag = json.load(f)
-                            if not summaries_bag:
-                                raise ValueError("Cannot generate HTML. Please summarize a couple of posts first.")
-                            generate_html_summary(summaries_bag, args.data_folder)
-                    except FileNotFoundError:
-                        logger.error("summaries.json file not found")
-                        raise FileNotFoundError("summaries.json file not found. Please ensure the file exists before generating the summary.")
+                    if not generate_html_summary(args.data_folder, configuration):
+                        logger.warning("No summary to publish. Please summarize a couple of posts first.")
+                case "search":
+                    if not args.query:
+                        raise ValueError("The search step needs the words to search for in --query.")
+                    search(args.query, args.search_limit)
                 case _:
                     logger.warning(f"Unknown step: {step}")        
     except Exception as e: